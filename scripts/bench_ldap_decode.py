@@ -0,0 +1,125 @@
+"""
+Микробенчмарк разбора ответа LDAP-поиска: стандартный разбор ldap3 с форматированием
+атрибутов по схеме AD против RawEntriesStrategy и decode_users_page. Записи кодируются
+в BER и разбираются той же стратегией, что и ответ сервера, поэтому сеть не участвует.
+Запуск: python -m scripts.bench_ldap_decode [число записей]
+"""
+
+import gc
+import sys
+from collections.abc import Callable
+from datetime import UTC, datetime, timedelta
+from time import perf_counter
+
+from ldap3 import OFFLINE_AD_2012_R2, SAFE_SYNC, Connection, Server
+from ldap3.protocol.rfc4511 import (
+    LDAPDN,
+    AttributeDescription,
+    AttributeValue,
+    LDAPMessage,
+    MessageID,
+    PartialAttribute,
+    PartialAttributeList,
+    ProtocolOp,
+    SearchResultEntry,
+    Vals,
+)
+from ldap3.utils.asn1 import decode_message_fast
+from loguru import logger
+from pyasn1.codec.ber import encoder
+
+from src.active_directory import ADUser, decode_users_page, use_raw_entries
+
+PAGE_SIZE = 1000
+
+
+def encode_entry(i: int) -> bytes:
+    attributes = {
+        "sAMAccountName": f"User{i}",
+        "userAccountControl": "512",
+        "msDS-User-Account-Control-Computed": "0",
+        "msDS-UserPasswordExpiryTimeComputed": str(133_900_000_000_000_000 + i * 10_000_000),
+    }
+    attribute_list = PartialAttributeList()
+    for pos, (name, value) in enumerate(attributes.items()):
+        vals = Vals()
+        vals.setComponentByPosition(0, AttributeValue(value))
+        attribute = PartialAttribute()
+        attribute["type"] = AttributeDescription(name)
+        attribute["vals"] = vals
+        attribute_list.setComponentByPosition(pos, attribute)
+
+    entry = SearchResultEntry()
+    entry["object"] = LDAPDN(f"CN=User{i},OU=Users,DC=example,DC=com")
+    entry["attributes"] = attribute_list
+    message = LDAPMessage()
+    message["messageID"] = MessageID(i + 1)
+    message["protocolOp"] = ProtocolOp().setComponentByName("searchResEntry", entry)
+    return encoder.encode(message)
+
+
+def decode_formatted(response: list[dict]) -> dict[str, ADUser]:
+    # Так пользователи разбирались до decode_users_page
+    users = {}
+    for entry in response:
+        attributes = entry["attributes"]
+        login = str(attributes["sAMAccountName"])
+        expiry = int(attributes["msDS-UserPasswordExpiryTimeComputed"])
+        users[login.lower()] = ADUser(
+            login=login,
+            disabled=bool(int(attributes["userAccountControl"]) & 0x00000002),
+            pwd_expiry=None
+            if expiry in (0, 0x7FFFFFFFFFFFFFFF)
+            else datetime(1601, 1, 1, tzinfo=UTC) + timedelta(seconds=expiry / 10000000),
+            pwd_expired=bool(int(attributes["msDS-User-Account-Control-Computed"]) & 0x00800000),
+        )
+    return users
+
+
+def bench(
+    name: str,
+    messages: list[bytes],
+    conn: Connection,
+    decode: Callable[[list[dict]], dict[str, ADUser]],
+) -> tuple[float, dict[str, ADUser]]:
+    users: dict[str, ADUser] = {}
+    # Сборщик мусора на большом графе разобранных записей дает больше шума, чем сам разбор
+    gc.collect()
+    gc.disable()
+    start = perf_counter()
+    for i in range(0, len(messages), PAGE_SIZE):
+        page = [
+            conn.strategy.decode_response_fast(decode_message_fast(message))
+            for message in messages[i : i + PAGE_SIZE]
+        ]
+        users.update(decode(page))
+    elapsed = perf_counter() - start
+    gc.enable()
+    logger.info(f"{name:<10} {elapsed:8.3f}s  {len(messages) / elapsed:10.0f} entries/s")
+    return elapsed, users
+
+
+def main() -> None:
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    messages = [encode_entry(i) for i in range(count)]
+
+    # Прежняя конфигурация: схема сервера и проверка имен атрибутов по ней
+    formatted_conn = Connection(
+        Server("bench", get_info=OFFLINE_AD_2012_R2), client_strategy=SAFE_SYNC
+    )
+    raw_conn = Connection(Server("bench"), client_strategy=SAFE_SYNC)
+    use_raw_entries(raw_conn)
+
+    start = perf_counter()
+    for message in messages:
+        decode_message_fast(message)
+    logger.info(f"{'BER only':<10} {perf_counter() - start:8.3f}s  (included in both)")
+
+    formatted_time, formatted = bench("formatted", messages, formatted_conn, decode_formatted)
+    raw_time, raw = bench("raw", messages, raw_conn, decode_users_page)
+    assert formatted == raw
+    logger.info(f"Speedup: x{formatted_time / raw_time:.1f}")
+
+
+if __name__ == "__main__":
+    main()
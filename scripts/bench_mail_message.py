@@ -0,0 +1,63 @@
+"""
+Микробенчмарк сборки письма: объектная модель пакета email против MessageFactory.
+Запуск: python -m scripts.bench_mail_message [число писем]
+"""
+
+import sys
+from collections.abc import Callable
+from email.header import Header
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from time import perf_counter
+
+from loguru import logger
+
+from src.notification.mailsender import Email, MessageFactory
+
+SENDER_NAME = "Истечение срока действия пароля"
+SENDER_MAIL = "noreply@example.com"
+
+
+def make_email(i: int) -> Email:
+    text = f"Срок действия вашей учётной записи user{i} истекает через 7 дней!"
+    return Email(
+        recipient=f"user{i}@example.com",
+        subject=f"Истечение срока действия пароля user{i}: 7 дней",
+        content_plain=text,
+        content_html=f"<html><body><p>{text}</p></body></html>",
+    )
+
+
+def build_mime(email: Email) -> bytes:
+    # Так письмо собиралось до MessageFactory, as_bytes - аналог сериализации в send_message
+    message = MIMEMultipart("alternative")
+    message["From"] = f"{Header(SENDER_NAME).encode()} <{SENDER_MAIL}>"
+    message["Subject"] = email.subject
+    message["To"] = email.recipient
+    message.attach(MIMEText(email.content_plain, "plain", "utf-8"))
+    message.attach(MIMEText(email.content_html, "html", "utf-8"))
+    return message.as_bytes()
+
+
+def bench(name: str, build: Callable[[Email], bytes], emails: list[Email]) -> float:
+    start = perf_counter()
+    for email in emails:
+        build(email)
+    elapsed = perf_counter() - start
+    rate = len(emails) / elapsed
+    logger.info(f"{name:<16} {elapsed:8.3f}s  {rate:10.0f} messages/s")
+    return rate
+
+
+def main() -> None:
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+    emails = [make_email(i) for i in range(count)]
+    factory = MessageFactory(SENDER_NAME, SENDER_MAIL)
+
+    mime_rate = bench("MIMEMultipart", build_mime, emails)
+    factory_rate = bench("MessageFactory", factory.build, emails)
+    logger.info(f"Speedup: x{factory_rate / mime_rate:.1f}")
+
+
+if __name__ == "__main__":
+    main()
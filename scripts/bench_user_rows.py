@@ -0,0 +1,119 @@
+"""
+Бенчмарк выборки и записи пользователей: ORM-объекты DBUser против проекций строк
+с UPDATE по первичному ключу (executemany) и с UPDATE ... FROM unnest. Каждый вариант
+запускается в отдельном процессе, чтобы не смешивался пиковый RSS. Пользователи создаются в транзакции, которая в конце откатывается.
+Запуск: python -m scripts.bench_user_rows [число пользователей]
+"""
+
+import asyncio
+import resource
+import subprocess
+import sys
+from datetime import datetime, timedelta
+from time import perf_counter
+
+from loguru import logger
+from sqlalchemy import select, text, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.active_directory import REFRESH_UPDATE
+from src.database import db_engine_manager
+from src.database.models import DBUser
+from src.database.rows import UserToRefresh
+from src.utils import MSK
+
+VARIANTS = ["orm", "rows", "unnest"]
+
+# Строки создаются на стороне БД, чтобы не раздувать RSS до замера
+INSERT_USERS = """
+    INSERT INTO "user" (externaldb_id, externaldb_fio, externaldb_group, externaldb_email,
+                        ad_login, ad_disabled, ad_pwd_expired, last_ad_refresh,
+                        last_notification, next_refresh_at)
+    SELECT 'bench' || i, 'Фамилия Имя Отчество ' || i, 'Группа', 'user' || i || '@example.com',
+           'bench_user' || i, false, false, 'epoch', 'epoch', 'epoch'
+    FROM generate_series(1, :count) i
+"""
+
+
+def peak_rss_mb() -> float:
+    # В Linux ru_maxrss в килобайтах
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def run(variant: str, count: int) -> None:
+    async with db_engine_manager, db_engine_manager.get_engine().connect() as conn:
+        transaction = await conn.begin()
+        await conn.execute(text(INSERT_USERS), {"count": count})
+        session = AsyncSession(bind=conn)
+        is_bench = DBUser.externaldb_id.like("bench%")
+        baseline = peak_rss_mb()
+
+        start = perf_counter()
+        if variant == "orm":
+            users = list(await session.scalars(select(DBUser).where(is_bench)))
+        else:
+            result = await session.execute(UserToRefresh.select().where(is_bench))
+            users = [UserToRefresh(*row) for row in result]
+        load_time = perf_counter() - start
+
+        start = perf_counter()
+        now = datetime.now(MSK)
+        expiry = now + timedelta(days=10)
+        if variant == "orm":
+            for user in users:
+                user.ad_pwd_expiry = expiry
+                user.last_ad_refresh = now
+                user.next_refresh_at = now
+            await session.flush()
+        elif variant == "unnest":
+            await session.execute(
+                REFRESH_UPDATE,
+                {
+                    "ids": [user.id for user in users],
+                    "disabled": [False] * len(users),
+                    "pwd_expiries": [expiry] * len(users),
+                    "pwd_expired": [False] * len(users),
+                    "next_refresh_dates": [now] * len(users),
+                    "refreshed_at": now,
+                },
+            )
+        else:
+            await session.execute(
+                update(DBUser),
+                [
+                    {
+                        "id": user.id,
+                        "ad_pwd_expiry": expiry,
+                        "last_ad_refresh": now,
+                        "next_refresh_at": now,
+                    }
+                    for user in users
+                ],
+            )
+        write_time = perf_counter() - start
+
+        peak = peak_rss_mb()
+        await transaction.rollback()
+
+    logger.info(
+        f"{variant:<6} load {load_time:7.3f}s  write {write_time:7.3f}s  "
+        f"peak RSS {peak:7.1f} MB (+{peak - baseline:.1f} MB)"
+    )
+
+
+def main() -> None:
+    args = sys.argv[1:]
+    count = int(args[0]) if args else 100_000
+    if len(args) > 1:
+        asyncio.run(run(args[1], count))
+        return
+
+    logger.info(f"{count} users")
+    for variant in VARIANTS:
+        subprocess.run(
+            [sys.executable, "-m", "scripts.bench_user_rows", str(count), variant], check=True
+        )
+
+
+if __name__ == "__main__":
+    main()
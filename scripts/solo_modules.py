@@ -14,6 +14,7 @@ from src.database.db_utils import prepare_databse
 from src.database.models import DBUser
 from src.externaldb import ExternalDBSyncer
 from src.notification.notificator import Notificator
+from src.run_context import RunContext
 from src.utils import http_session_manager
 
 # ruff: noqa
@@ -39,7 +40,7 @@ async def run_syncers() -> None:
     await extdb.sync()
 
     ad = ADSyncer()
-    await ad.sync()
+    await ad.sync(RunContext())
 
 
 if __name__ == "__main__":
@@ -1,16 +1,41 @@
-from dataclasses import dataclass
+import asyncio
+import threading
+from collections.abc import Callable, Iterable
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
 from datetime import UTC, datetime, timedelta
-from typing import Any, Self
-
-from ldap3 import SAFE_SYNC, Connection, Server
-from ldap3.core.exceptions import LDAPException
+from time import monotonic
+from typing import Any, Self, TypeVar, override
+
+from ldap3 import BASE, NONE, SAFE_SYNC, Connection, Server
+from ldap3.core.exceptions import LDAPCommunicationError, LDAPException
+from ldap3.core.results import RESULT_SIZE_LIMIT_EXCEEDED, RESULT_SUCCESS
+from ldap3.strategy.safeSync import SafeSyncStrategy
+from ldap3.utils.conv import escape_filter_chars
 from loguru import logger
-from sqlalchemy import select
-
+from sqlalchemy import (
+    ARRAY,
+    Boolean,
+    DateTime,
+    Integer,
+    String,
+    Update,
+    and_,
+    any_,
+    bindparam,
+    column,
+    func,
+    or_,
+    select,
+    update,
+)
+
+from src import metrics
 from src.config import settings
 from src.database import db_sessionmaker
-from src.database.models import DBUser
-from src.utils import MSK
+from src.database.models import DBSyncState, DBUser
+from src.database.rows import UserToRefresh
+from src.run_context import RunContext
 
 
 @dataclass
@@ -21,60 +46,456 @@ class ADUser:
     pwd_expired: bool
 
 
+@dataclass
+class ADServerState:
+    server_id: str
+    highest_usn: int
+
+
+T = TypeVar("T")
+
+# Только пользователи, без компьютеров и контактов
+_ALL_USERS_FILTER = "(&(objectCategory=person)(objectClass=user))"
+_PAGED_RESULTS_OID = "1.2.840.113556.1.4.319"
+_SEARCH_RES_ENTRY = 4
+# Отметка uSNChanged хранится для каждого контроллера домена: ad_usn_changed:<dsServiceName>
+_USN_STATE_NAME = "ad_usn_changed"
+
+# FILETIME - число 100-наносекундных интервалов с 1601-01-01 UTC.
+# 0 и 0x7FFFFFFFFFFFFFFF означают, что срок действия не ограничен
+_FILETIME_EPOCH = datetime(1601, 1, 1, tzinfo=UTC)
+_FILETIME_NEVER = (0, 0x7FFFFFFFFFFFFFFF)
+_UAC_ACCOUNTDISABLE = 0x00000002
+_UAC_PASSWORD_EXPIRED = 0x00800000
+
+
+def filetime_to_datetime(filetime: int) -> datetime:
+    # Целочисленное деление без перехода к float, точность - микросекунда
+    return _FILETIME_EPOCH + timedelta(microseconds=filetime // 10)
+
+
+def decode_users_page(response: list[dict]) -> dict[str, ADUser]:
+    """
+    Разбирает страницу результатов поиска по raw_attributes (байты, как пришли от сервера),
+    минуя форматирование атрибутов ldap3. Возвращает индекс по sAMAccountName
+    в нижнем регистре, записи с неожиданными атрибутами пропускаются
+    """
+    users: dict[str, ADUser] = {}
+    for entry in response:
+        if entry.get("type") != "searchResEntry":
+            continue
+        raw = entry["raw_attributes"]
+        try:
+            login = raw["sAMAccountName"][0].decode()
+            uac = int(raw["userAccountControl"][0])
+            uac_computed = int(raw["msDS-User-Account-Control-Computed"][0])
+            expiry = int(raw["msDS-UserPasswordExpiryTimeComputed"][0])
+        except (KeyError, IndexError, TypeError, ValueError, UnicodeDecodeError) as e:
+            logger.error(f"Unexpected AD attributes for {entry.get('dn')}: {e!r}")
+            continue
+
+        users[login.lower()] = ADUser(
+            login=login,
+            disabled=bool(uac & _UAC_ACCOUNTDISABLE),
+            pwd_expiry=None if expiry in _FILETIME_NEVER else filetime_to_datetime(expiry),
+            pwd_expired=bool(uac_computed & _UAC_PASSWORD_EXPIRED),
+        )
+    return users
+
+
+# (id, ad_disabled, ad_pwd_expiry, ad_pwd_expired, next_refresh_at)
+_RefreshedUser = tuple[int, bool, datetime | None, bool, datetime]
+
+
+def _build_refresh_update() -> Update:
+    """
+    UPDATE ... FROM unnest(...): значения передаются массивами по столбцам,
+    и пачка пользователей записывается одним запросом
+    """
+    users = DBUser.__table__
+    refreshed = (
+        func.unnest(
+            bindparam("ids", type_=ARRAY(Integer)),
+            bindparam("disabled", type_=ARRAY(Boolean)),
+            bindparam("pwd_expiries", type_=ARRAY(DateTime(timezone=True))),
+            bindparam("pwd_expired", type_=ARRAY(Boolean)),
+            bindparam("next_refresh_dates", type_=ARRAY(DateTime(timezone=True))),
+        )
+        .table_valued(
+            column("id", Integer),
+            column("ad_disabled", Boolean),
+            column("ad_pwd_expiry", DateTime(timezone=True)),
+            column("ad_pwd_expired", Boolean),
+            column("next_refresh_at", DateTime(timezone=True)),
+        )
+        .render_derived("refreshed")
+    )
+    return (
+        update(users)
+        .where(users.c.id == refreshed.c.id)
+        .values(
+            ad_disabled=refreshed.c.ad_disabled,
+            ad_pwd_expiry=refreshed.c.ad_pwd_expiry,
+            ad_pwd_expired=refreshed.c.ad_pwd_expired,
+            next_refresh_at=refreshed.c.next_refresh_at,
+            last_ad_refresh=bindparam("refreshed_at"),
+        )
+    )
+
+
+REFRESH_UPDATE = _build_refresh_update()
+
+
 class ADSyncer:
     """
     Синхронизирует БД приложения с Active Directory
     """
 
     def __init__(self) -> None:
-        self._ad = ADClient()
+        self._pool = ADClientPool(settings.ad_sync.pool_size)
+        self._batch_size = settings.ad_sync.batch_size
+        self._snapshot_min_ratio = settings.ad_sync.snapshot_min_ratio
+        self._incremental = settings.ad_sync.incremental
+        self._max_refresh_interval_days = settings.ad_sync.max_refresh_interval_days
+        self._write_chunk_size = settings.ad_sync.write_chunk_size
+        self._notify_at_days_to_expiry = settings.notify_at_days_to_expiry
 
     def test_connection(self) -> None:
-        self._ad.test_connection()
-
-    async def sync(self) -> None:
+        self._pool.test_connection()
+
+    async def sync(
+        self, run: RunContext, refreshed: "asyncio.Queue[list[int] | None] | None" = None
+    ) -> None:
+        """
+        run - момент запуска, от которого считаются сроки и даты обновления.
+        refreshed - очередь конвейерного режима (см. src.pipeline): в нее по мере сохранения
+        передаются id обновленных пользователей, которым сегодня положено уведомление
+        """
         logger.info("Syncing with AD")
 
         async with db_sessionmaker() as session:
-            result = await session.scalars(select(DBUser))
-            users = list(result)
+            result = await session.scalars(
+                select(DBSyncState)
+                .where(DBSyncState.name.startswith(_USN_STATE_NAME, autoescape=True))
+                .order_by(DBSyncState.updated_at)
+            )
+            usn_marks = {usn_mark.source: usn_mark for usn_mark in result}
+
+        async with self._pool:
+            if self._incremental:
+                await self._sync_changes(run, usn_marks, refreshed)
+
+            # Пользователи, обновленные по изменениям, уже сохранены с новым next_refresh_at.
+            # Кандидаты на сегодняшние уведомления перечитываются, если еще не обновлялись сегодня
+            async with db_sessionmaker() as session:
+                users_count = await session.scalar(select(func.count()).select_from(DBUser))
+                result = await session.execute(
+                    UserToRefresh.select().where(
+                        or_(
+                            DBUser.next_refresh_at <= run.now,
+                            and_(
+                                DBUser.expires_in_days(self._notify_at_days_to_expiry, run.today),
+                                DBUser.last_ad_refresh < run.start_of_day(),
+                            ),
+                        )
+                    )
+                )
+                users = [UserToRefresh(*row) for row in result]
+            logger.info(f"Refreshing AD data for {len(users)} users")
+
+            if users and len(users) / (users_count or 1) >= self._snapshot_min_ratio:
+                ad_users = await self._get_users_from_snapshot(users)
+                await self._save_refreshed(run, users, ad_users, refreshed)
+            else:
+                await self._refresh_in_batches(run, users, refreshed)
 
-        users = [user for user in users if self._should_be_synced(user)]
-        logger.info(f"Refreshing AD data for {len(users)} users")
+        logger.success("Done syncing with AD")
 
-        with self._ad:
-            for user in users:
-                self._sync_one_user(user)
+    async def _refresh_in_batches(
+        self,
+        run: RunContext,
+        users: list[UserToRefresh],
+        refreshed: "asyncio.Queue[list[int] | None] | None",
+    ) -> None:
+        """
+        Каждая пачка сохраняется, как только ответил AD, не дожидаясь остальных.
+        Ошибка в любой пачке отменяет остальные, и обновление завершается
+        """
+        save_lock = asyncio.Lock()
+
+        async def _refresh(batch: list[UserToRefresh]) -> None:
+            ad_users = await self._get_users(user.ad_login for user in batch)
+            # Пачки записываются по одной, в порядке ответов AD
+            async with save_lock:
+                await self._save_refreshed(run, batch, ad_users, refreshed)
+
+        async with asyncio.TaskGroup() as tg:
+            for i in range(0, len(users), self._batch_size):
+                tg.create_task(_refresh(users[i : i + self._batch_size]))
+
+    async def _save_refreshed(
+        self,
+        run: RunContext,
+        users: list[UserToRefresh],
+        ad_users: dict[str, ADUser | None],
+        refreshed: "asyncio.Queue[list[int] | None] | None",
+    ) -> None:
+        """
+        Записывает результаты пачками по write_chunk_size, каждая в своей транзакции:
+        ошибка в конце долгого прохода не откатывает уже сохраненное
+        """
+        updates, candidates = self._get_updates(run, users, ad_users)
+
+        logger.debug(f"Saving refreshed AD data for {len(updates)} users to DB")
+        for i in range(0, len(updates), self._write_chunk_size):
+            chunk = updates[i : i + self._write_chunk_size]
+            ids, disabled, pwd_expiries, pwd_expired, next_refresh_at = (
+                list(values) for values in zip(*chunk, strict=True)
+            )
+            async with db_sessionmaker.begin() as session:
+                await session.execute(
+                    REFRESH_UPDATE,
+                    {
+                        "ids": ids,
+                        "disabled": disabled,
+                        "pwd_expiries": pwd_expiries,
+                        "pwd_expired": pwd_expired,
+                        "next_refresh_dates": next_refresh_at,
+                        "refreshed_at": run.now,
+                    },
+                )
+            await self._publish_candidates(
+                [user_id for user_id in ids if user_id in candidates], refreshed
+            )
 
-        logger.info("Saving refreshed AD data to DB")
-        async with db_sessionmaker.begin() as session:
-            session.add_all(users)
+    async def _publish_candidates(
+        self, candidates: list[int], refreshed: "asyncio.Queue[list[int] | None] | None"
+    ) -> None:
+        if refreshed is not None and candidates:
+            # Очередь ограничена: если уведомления не успевают, обновление из AD ждет
+            await refreshed.put(candidates)
+
+    async def _sync_changes(
+        self,
+        run: RunContext,
+        usn_marks: dict[str, DBSyncState],
+        refreshed: "asyncio.Queue[list[int] | None] | None",
+    ) -> None:
+        """
+        Обновляет пользователей, чьи записи в AD изменились с прошлого запуска (по uSNChanged).
+        uSNChanged локален для контроллера домена, поэтому отметка хранится для каждого
+        контроллера: подключение к другому быстрейшему контроллеру читает изменения
+        от его собственной отметки. Полное обновление выполняется, только если у контроллера
+        еще нет отметки или она некорректна
+        """
+        try:
+            server, changed, is_full = await self._pool.run(
+                lambda ad: self._read_changes(ad, usn_marks)
+            )
+        except ADError as e:
+            logger.opt(exception=e).error("Incremental AD sync failed")
+            return
 
-        logger.success("Done syncing with AD")
+        stmt = UserToRefresh.select()
+        if not is_full:
+            logins = bindparam("logins", list(changed), ARRAY(String))
+            stmt = stmt.where(func.lower(DBUser.ad_login) == any_(logins))
+        async with db_sessionmaker() as session:
+            result = await session.execute(stmt)
+            users = [UserToRefresh(*row) for row in result]
+
+        logger.info(f"Applying AD changes to {len(users)} users")
+        ad_users = {user.ad_login: changed.get(user.ad_login.lower()) for user in users}
+        await self._save_refreshed(run, users, ad_users, refreshed)
+
+        # Отметка сохраняется после всех изменений: если запись прервалась,
+        # следующий запуск перечитает те же изменения
+        new_usn_mark = DBSyncState(
+            name=f"{_USN_STATE_NAME}:{server.server_id}",
+            source=server.server_id,
+            watermark=str(server.highest_usn),
+            updated_at=run.now,
+        )
+        async with db_sessionmaker.begin() as session:
+            await session.merge(new_usn_mark)
+
+    def _read_changes(
+        self, ad: "ADClient", usn_marks: dict[str, DBSyncState]
+    ) -> tuple[ADServerState, dict[str, ADUser], bool]:
+        # Состояние сервера и изменения должны читаться через одно подключение (один контроллер)
+        server = ad.get_server_state()
+        last_usn = self._get_valid_usn(usn_marks.get(server.server_id), server)
+        if last_usn is None:
+            logger.info("No valid uSNChanged mark for this domain controller, full AD refresh")
+            return server, ad.get_all_users(), True
+
+        logger.info(f"Reading AD entries changed since uSNChanged={last_usn}")
+        return server, ad.get_changed_users(last_usn), False
+
+    def _get_valid_usn(self, usn_mark: DBSyncState | None, server: ADServerState) -> int | None:
+        if not usn_mark or usn_mark.source != server.server_id:
+            return None
+        try:
+            last_usn = int(usn_mark.watermark)
+        except ValueError:
+            return None
+        if not 0 <= last_usn <= server.highest_usn:
+            return None
+        return last_usn
+
+    async def _get_users(self, logins: Iterable[str]) -> dict[str, ADUser | None]:
+        """
+        Раскидывает пачки логинов по подключениям пула
+        """
+        unique_logins = list(dict.fromkeys(logins))
+        batches = [
+            unique_logins[i : i + self._batch_size]
+            for i in range(0, len(unique_logins), self._batch_size)
+        ]
+        results = await asyncio.gather(
+            *(self._pool.run(lambda ad, batch=batch: ad.get_users(batch)) for batch in batches),
+            return_exceptions=True,
+        )
 
-    def _sync_one_user(self, user: DBUser) -> None:
+        ad_users: dict[str, ADUser | None] = {}
+        for batch, result in zip(batches, results, strict=True):
+            if isinstance(result, BaseException):
+                logger.opt(exception=result).error(f"AD lookup for {len(batch)} users failed")
+            else:
+                ad_users.update(result)
+        return ad_users
+
+    async def _get_users_from_snapshot(
+        self, users: list[UserToRefresh]
+    ) -> dict[str, ADUser | None]:
+        logger.info("Most users are due for refresh, reading the whole search base from AD")
         try:
-            ad_user = self._ad.get_user(user.ad_login)
+            snapshot = await self._pool.run(lambda ad: ad.get_all_users())
         except ADError as e:
-            logger.opt(exception=e).error("Error getting user from AD")
-            return
+            logger.opt(exception=e).error("AD snapshot failed, falling back to batched lookups")
+            return await self._get_users(user.ad_login for user in users)
+
+        return {user.ad_login: snapshot.get(user.ad_login.lower()) for user in users}
+
+    def _get_updates(
+        self, run: RunContext, users: list[UserToRefresh], ad_users: dict[str, ADUser | None]
+    ) -> tuple[list[_RefreshedUser], set[int]]:
+        """
+        Обновленные значения пользователей и id тех, кому сегодня положено уведомление.
+        Пользователи, для которых поиск завершился ошибкой (она уже залогирована)
+        или которых нет в AD, не обновляются
+        """
+        updates: list[_RefreshedUser] = []
+        candidates: set[int] = set()
+        for user in users:
+            if user.ad_login not in ad_users:
+                continue
+
+            ad_user = ad_users[user.ad_login]
+            if not ad_user:
+                logger.warning(f"User {user.ad_login} not found in AD")
+                continue
+
+            days_to_expiry = run.days_to_expiry(
+                ad_user.pwd_expiry, disabled=ad_user.disabled, expired=ad_user.pwd_expired
+            )
+            if days_to_expiry in self._notify_at_days_to_expiry:
+                candidates.add(user.id)
+            logger.debug(f"User {user.ad_login} password expires in {days_to_expiry} days")
+            updates.append(
+                (
+                    user.id,
+                    ad_user.disabled,
+                    ad_user.pwd_expiry,
+                    ad_user.pwd_expired,
+                    self._get_next_refresh_at(run, days_to_expiry),
+                )
+            )
+        return updates, candidates
 
-        if not ad_user:
-            logger.warning(f"User {user.ad_login} not found in AD")
-        else:
-            user.ad_disabled = ad_user.disabled
-            user.ad_pwd_expiry = ad_user.pwd_expiry
-            user.ad_pwd_expired = ad_user.pwd_expired
-            user.last_ad_refresh = datetime.now(MSK)
-        logger.debug(f"User {user.ad_login} password expires in {user.ad_pwd_expires_in_days} days")
+    def _get_next_refresh_at(self, run: RunContext, days_to_expiry: int | None) -> datetime:
+        """
+        Следующее обновление - в день, когда пользователь попадет на ближайший порог
+        уведомления (или в день истечения пароля), но не реже max_refresh_interval_days
+        """
+        latest = run.now + timedelta(days=self._max_refresh_interval_days)
+
+        if days_to_expiry is None:
+            return latest
+
+        days_until_refresh = [
+            days_to_expiry - days
+            for days in [*self._notify_at_days_to_expiry, 0]
+            if days < days_to_expiry
+        ]
+        if not days_until_refresh:
+            return latest
+
+        return min(latest, run.start_of_day(min(days_until_refresh)))
+
+
+class ADServerRouter:
+    """
+    Выбирает контроллер домена для подключения: доступные сервера упорядочены
+    по задержке, недоступные исключаются на server_retry_after_seconds.
+    Используется из потоков пула, поэтому все изменения под блокировкой
+    """
+
+    _EWMA_WEIGHT = 0.3
+
+    def __init__(self, urls: list[str]) -> None:
+        self._urls = urls
+        self._parallel_servers = settings.ad_sync.parallel_servers
+        self._retry_after = settings.ad_sync.server_retry_after_seconds
+        self._latency: dict[tuple[str, str], float] = {}
+        self._failed_until: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def get_candidates(self, spread_index: int = 0) -> list[str]:
+        """
+        Сервера в порядке предпочтения. spread_index раскидывает подключения пула
+        по parallel_servers самым быстрым серверам
+        """
+        with self._lock:
+            now = monotonic()
+            healthy = sorted(
+                (url for url in self._urls if self._failed_until.get(url, 0) <= now),
+                key=self._score,
+            )
+            failed = sorted(
+                (url for url in self._urls if url not in healthy),
+                key=lambda url: self._failed_until[url],
+            )
 
-    def _should_be_synced(self, user: DBUser) -> bool:
-        if (
-            user.ad_pwd_expires_in_days is None
-            and datetime.now(MSK) - user.last_ad_refresh >= timedelta(days=14)
-        ) or user.ad_pwd_expires_in_days in settings.notify_at_days_to_expiry:
-            return True
-        return False
+        if healthy:
+            first = spread_index % min(len(healthy), self._parallel_servers)
+            healthy = healthy[first:] + healthy[:first]
+        # Недоступные сервера остаются последним вариантом
+        return healthy + failed
+
+    def record_latency(self, url: str, operation: str, seconds: float) -> None:
+        with self._lock:
+            self._failed_until.pop(url, None)
+            previous = self._latency.get((url, operation))
+            if previous is not None:
+                seconds = previous + self._EWMA_WEIGHT * (seconds - previous)
+            self._latency[(url, operation)] = seconds
+
+        metrics.ad_server_latency.labels(url, operation).set(seconds)
+        metrics.ad_server_up.labels(url).set(1)
+
+    def mark_failed(self, url: str) -> None:
+        logger.warning(f"AD server {url} is unavailable, excluding it for {self._retry_after}s")
+        with self._lock:
+            self._failed_until[url] = monotonic() + self._retry_after
+        metrics.ad_server_up.labels(url).set(0)
+
+    def _score(self, url: str) -> float:
+        # Сервера без замеров получают наивысший приоритет, чтобы их задержка была измерена
+        latency = self._latency.get((url, "search"))
+        if latency is None:
+            latency = self._latency.get((url, "bind"), 0.0)
+        return latency
 
 
 class ADClient:
@@ -83,16 +504,14 @@ class ADClient:
     Технические подробности взяты из: https://github.com/moreati/ActiveDirectory-Python/blob/master/activedirectory.py
     """
 
-    def __init__(self) -> None:
-        self._server = Server(settings.active_directory.url)
-        self._conn = Connection(
-            self._server,
-            user=settings.active_directory.user.get_secret_value(),
-            password=settings.active_directory.password.get_secret_value(),
-            client_strategy=SAFE_SYNC,
-            auto_bind=False,
-        )
+    def __init__(self, router: ADServerRouter | None = None, spread_index: int = 0) -> None:
+        self._router = router or ADServerRouter(settings.active_directory.urls)
+        self._spread_index = spread_index
+        self._url = self._router.get_candidates(spread_index)[0]
+        self._conn = self._make_connection(self._url)
         self._search_base = settings.search_base
+        self._batch_size = settings.ad_sync.batch_size
+        self._snapshot_page_size = settings.ad_sync.snapshot_page_size
 
     def test_connection(self) -> None:
         logger.info("Testing AD connection")
@@ -100,73 +519,341 @@ class ADClient:
             pass
 
     def __enter__(self) -> Self:
-        status, result, _, _ = self._conn.bind()
-        if not status:
-            err = f"Error connecting to AD server: {result['description']}"
-            raise ADError(err)
-
+        self.bind()
         return self
 
     def __exit__(self, *exc: object) -> None:
-        self._conn.unbind()
+        self.unbind()
+
+    def bind(self) -> None:
+        """
+        Подключается к самому быстрому из доступных контроллеров домена,
+        при ошибке подключения переходит к следующему
+        """
+        errors: list[str] = []
+        for url in self._router.get_candidates(self._spread_index):
+            self._url = url
+            self._conn = self._make_connection(url)
+
+            started = monotonic()
+            try:
+                status, result, _, _ = self._conn.bind()
+            except LDAPException as e:
+                self._router.mark_failed(url)
+                errors.append(f"{url}: {e!r}")
+                continue
+
+            if not status:
+                err = f"Error connecting to AD server {url}: {result['description']}"
+                raise ADError(err)
+
+            self._router.record_latency(url, "bind", monotonic() - started)
+            logger.debug(f"Bound to AD server {url}")
+            return
+
+        raise ADConnectionError(f"Error connecting to AD servers: {'; '.join(errors)}")
 
-    def get_user(self, login: str) -> ADUser | None:
-        logger.debug(f"Looking for user {login} in AD")
+    def unbind(self) -> None:
+        try:
+            self._conn.unbind()
+        except LDAPException as e:
+            logger.warning(f"Error unbinding from AD server: {e!r}")
 
-        status, result, response = self._get_user_from_ad(login)
+    def rebind(self) -> None:
+        self.unbind()
+        self.bind()
 
+    def _make_connection(self, url: str) -> Connection:
+        # Ответы разбираются по raw_attributes, схема сервера не нужна
+        conn = Connection(
+            Server(url, get_info=NONE),
+            user=settings.active_directory.user.get_secret_value(),
+            password=settings.active_directory.password.get_secret_value(),
+            client_strategy=SAFE_SYNC,
+            auto_bind=False,
+        )
+        use_raw_entries(conn)
+        return conn
+
+    def get_users(self, logins: Iterable[str]) -> dict[str, ADUser | None]:
+        """
+        Ищет пользователей пачками по batch_size логинов в одном OR-фильтре.
+        Для ненайденных пользователей возвращает None, а логины, поиск по которым
+        завершился ошибкой, в результат не попадают
+        """
+        unique_logins = list(dict.fromkeys(logins))
+        logger.debug(
+            f"Looking for {len(unique_logins)} users in AD in batches of {self._batch_size}"
+        )
+
+        users: dict[str, ADUser | None] = {}
+        for i in range(0, len(unique_logins), self._batch_size):
+            users.update(self._get_users_batch(unique_logins[i : i + self._batch_size]))
+        return users
+
+    def _get_users_batch(self, logins: list[str]) -> dict[str, ADUser | None]:
+        try:
+            found = self._search_users(logins)
+        except ADConnectionError:
+            raise
+        except ADError as e:
+            if len(logins) == 1:
+                logger.opt(exception=e).error(f"Error getting user {logins[0]} from AD")
+                return {}
+
+            # Один некорректный логин не должен ломать поиск остальных в пачке
+            logger.warning(f"Batch AD search failed, retrying one by one: {e}")
+            users: dict[str, ADUser | None] = {}
+            for login in logins:
+                users.update(self._get_users_batch([login]))
+            return users
+
+        users = {}
+        for login in logins:
+            user = found.get(login.lower())
+            if user is None:
+                logger.debug(f"Did not find user {login} in AD")
+            elif user.login != login:
+                # Логин в БД может отличаться от AD регистром
+                user = replace(user, login=login)
+            users[login] = user
+        return users
+
+    def get_server_state(self) -> ADServerState:
+        """
+        Читает из rootDSE идентификатор контроллера домена и его текущий highestCommittedUSN
+        """
+        status, result, response = self._search(
+            "",
+            "(objectClass=*)",
+            search_scope=BASE,
+            attributes=["dsServiceName", "highestCommittedUSN"],
+        )
         if not status or not response:
-            logger.debug(f"Did not find user {login} in AD: {result!s}")
-            return None
+            raise ADError(f"Reading AD rootDSE failed: {result['description']}")
 
-        user = response[0]
-        return ADUser(
-            login=login,
-            disabled=self._user_get_disabled(user),
-            pwd_expiry=self._user_get_pwd_expiry_from(user),
-            pwd_expired=self._user_get_pwd_expired(user),
+        raw = response[0]["raw_attributes"]
+        return ADServerState(
+            server_id=raw["dsServiceName"][0].decode(),
+            highest_usn=int(raw["highestCommittedUSN"][0]),
+        )
+
+    def get_all_users(self) -> dict[str, ADUser]:
+        """
+        Выгружает всех пользователей из search_base постраничным поиском (paged results).
+        Возвращает индекс по sAMAccountName в нижнем регистре
+        """
+        logger.debug("Reading all users from AD")
+        return self._get_users_paged(_ALL_USERS_FILTER)
+
+    def get_changed_users(self, since_usn: int) -> dict[str, ADUser]:
+        """
+        Выгружает пользователей, измененных после since_usn, в том же формате, что get_all_users
+        """
+        logger.debug(f"Reading users changed since uSNChanged={since_usn} from AD")
+        return self._get_users_paged(
+            f"(&(objectCategory=person)(objectClass=user)(uSNChanged>={since_usn + 1}))"
         )
 
-    def _get_user_from_ad(self, login: str) -> tuple[bool, dict, dict]:
+    def _get_users_paged(self, search_filter: str) -> dict[str, ADUser]:
+        users: dict[str, ADUser] = {}
+        cookie: bytes | None = None
+        pages = 0
+        while True:
+            _, result, response = self._get_user_from_ad(
+                search_filter, paged_size=self._snapshot_page_size, paged_cookie=cookie
+            )
+            if result["result"] != RESULT_SUCCESS:
+                raise ADError(
+                    f"AD paged search failed: {result['description']} {result['message']}"
+                )
+
+            pages += 1
+            users.update(decode_users_page(response))
+
+            cookie = (
+                result.get("controls", {})
+                .get(_PAGED_RESULTS_OID, {})
+                .get("value", {})
+                .get("cookie")
+            )
+            if not cookie:
+                break
+
+        logger.debug(f"Read {len(users)} users from AD in {pages} pages")
+        return users
+
+    def _search_users(self, logins: list[str]) -> dict[str, ADUser]:
+        if len(logins) == 1:
+            search_filter = f"(sAMAccountName={escape_filter_chars(logins[0])})"
+        else:
+            search_filter = "(|{})".format(
+                "".join(f"(sAMAccountName={escape_filter_chars(login)})" for login in logins)
+            )
+
+        _, result, response = self._get_user_from_ad(search_filter)
+        if result["result"] not in (RESULT_SUCCESS, RESULT_SIZE_LIMIT_EXCEEDED):
+            raise ADError(f"AD search failed: {result['description']} {result['message']}")
+
+        return decode_users_page(response)
+
+    def _get_user_from_ad(
+        self,
+        search_filter: str,
+        paged_size: int | None = None,
+        paged_cookie: bytes | None = None,
+    ) -> tuple[bool, dict, list]:
+        return self._search(
+            self._search_base,
+            search_filter,
+            paged_size=paged_size,
+            paged_cookie=paged_cookie,
+            attributes=[
+                "sAMAccountName",
+                "userAccountControl",
+                "msDS-UserPasswordExpiryTimeComputed",  # Вычисленная дата истечения пароля, учитывает FGPP (гранулированные политики паролей)
+                "msDS-User-Account-Control-Computed",
+            ],
+        )
+
+    def _search(self, search_base: str, search_filter: str, **kw: Any) -> tuple[bool, dict, list]:
         if not self._conn.bound:
-            raise ADError("Connection to AD must be bound before making requests")
+            raise ADConnectionError("Connection to AD must be bound before making requests")
 
+        started = monotonic()
         try:
-            status, result, response, _ = self._conn.search(
-                self._search_base,
-                f"(sAMAccountName={login})",
-                attributes=[
-                    "userAccountControl",
-                    "msDS-UserPasswordExpiryTimeComputed",  # Вычисленная дата истечения пароля, учитывает FGPP (гранулированные политики паролей)
-                    "msDS-User-Account-Control-Computed",
-                ],
-            )
+            status, result, response, _ = self._conn.search(search_base, search_filter, **kw)
+        except LDAPCommunicationError as e:
+            self._router.mark_failed(self._url)
+            raise ADConnectionError(
+                f"AD search {search_filter} on {self._url} failed: {e!r}"
+            ) from e
         except LDAPException as e:
-            raise ADError(f"AD search for user {login} failed: {e!r}") from e
+            raise ADError(f"AD search {search_filter} failed: {e!r}") from e
+
+        self._router.record_latency(self._url, "search", monotonic() - started)
         return status, result, response
 
-    def _user_get_disabled(self, user: Any) -> bool:
-        uac = int(user["attributes"]["userAccountControl"])
-        return bool(uac & 0x00000002)
 
-    def _user_get_pwd_expired(self, user: Any) -> bool:
-        uac_live = int(user["attributes"]["msDS-User-Account-Control-Computed"])
-        return bool(uac_live & 0x00800000)
+class RawEntriesStrategy(SafeSyncStrategy):
+    """
+    SAFE_SYNC, который отдает записи поиска только с raw_attributes. Стандартный разбор
+    ldap3 для каждой записи декодирует и форматирует значения и строит два словаря
+    атрибутов, что на больших выгрузках обходится дороже сети
+    """
 
-    def _user_get_pwd_expiry_from(self, user: Any) -> datetime | None:
-        expiry_time = int(user["attributes"]["msDS-UserPasswordExpiryTimeComputed"])
+    @override
+    def decode_response_fast(self, ldap_message: dict) -> dict:
+        # Записи с controls редки, их разбирает ldap3
+        if ldap_message["protocolOp"] != _SEARCH_RES_ENTRY or ldap_message["controls"]:
+            return super().decode_response_fast(ldap_message)
+
+        dn, attributes = ldap_message["payload"][0][3], ldap_message["payload"][1][3]
+        return {
+            "type": "searchResEntry",
+            "dn": dn.decode(errors="replace"),
+            "raw_attributes": {
+                attribute[3][0][3].decode(): [value[3] for value in attribute[3][1][3]]
+                for attribute in attributes
+            },
+            # ldap3 дописывает сюда пустые списки для отсутствующих атрибутов
+            "attributes": {},
+        }
+
+
+def use_raw_entries(conn: Connection) -> None:
+    """
+    Переключает подключение SAFE_SYNC на RawEntriesStrategy.
+
+    ldap3 выбирает класс стратегии по константе client_strategy и не принимает свой класс,
+    а Connection при создании сохраняет ссылки на методы стратегии (send, get_response и т.д.).
+    Поэтому подменяется класс уже созданной стратегии: RawEntriesStrategy только переопределяет
+    decode_response_fast и не добавляет состояния, а сохраненные методы продолжают работать.
+    Подмена безопасна только для SafeSyncStrategy, для любого другого класса
+    (другой client_strategy или другая версия ldap3) вызывается TypeError
+    """
+    strategy_class = type(conn.strategy)
+    if strategy_class is RawEntriesStrategy:
+        return
+    if strategy_class is not SafeSyncStrategy:
+        raise TypeError(
+            f"RawEntriesStrategy requires {SafeSyncStrategy.__name__}, got {strategy_class.__name__}"
+        )
+    conn.strategy.__class__ = RawEntriesStrategy
 
-        # A value of 0 or 0x7FFFFFFFFFFFFFFF indicates that the account never expires.
-        if expiry_time in (0, 0x7FFFFFFFFFFFFFFF):
-            return None
 
-        return self._ad_time_to_datetime(expiry_time)
+class ADClientPool:
+    """
+    Пул подключений к AD. Блокирующие запросы ldap3 выполняются в пуле потоков,
+    каждое подключение в один момент времени используется только одним потоком
+    """
+
+    def __init__(self, size: int) -> None:
+        router = ADServerRouter(settings.active_directory.urls)
+        self._clients = [ADClient(router, spread_index=i) for i in range(size)]
+
+    def test_connection(self) -> None:
+        self._clients[0].test_connection()
+
+    async def __aenter__(self) -> Self:
+        logger.debug(f"Binding {len(self._clients)} AD connections")
+        self._executor = ThreadPoolExecutor(len(self._clients), thread_name_prefix="ad")
+        self._idle: asyncio.Queue[ADClient] = asyncio.Queue()
 
-    def _ad_time_to_datetime(self, ad_time: int) -> datetime:
-        # AD's date format is 100 nanosecond intervals since Jan 1 1601 in GMT.
-        # To convert to seconds, divide by 10000000.
-        return datetime(1601, 1, 1, tzinfo=UTC) + timedelta(seconds=ad_time / 10000000)
+        loop = asyncio.get_running_loop()
+        try:
+            await asyncio.gather(
+                *(loop.run_in_executor(self._executor, client.bind) for client in self._clients)
+            )
+        except BaseException:
+            await self.__aexit__()
+            raise
+
+        for client in self._clients:
+            self._idle.put_nowait(client)
+        metrics.ad_pool_size.set(len(self._clients))
+        return self
+
+    async def __aexit__(self, *exc: object) -> None:
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(
+            *(loop.run_in_executor(self._executor, client.unbind) for client in self._clients)
+        )
+        self._executor.shutdown()
+        metrics.ad_pool_size.set(0)
+
+    async def run(self, func: Callable[[ADClient], T]) -> T:
+        """
+        Выполняет func на свободном подключении в пуле потоков.
+        Запрос в потоке нельзя прервать, поэтому при отмене подключение
+        возвращается в пул только после его завершения
+        """
+        client = await self._idle.get()
+        metrics.ad_pool_busy.inc()
+        try:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self._executor, self._run_with_rebind, client, func)
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                await asyncio.wait([future])
+                raise
+        finally:
+            metrics.ad_pool_busy.dec()
+            self._idle.put_nowait(client)
+
+    def _run_with_rebind(self, client: ADClient, func: Callable[[ADClient], T]) -> T:
+        try:
+            return func(client)
+        except ADConnectionError as e:
+            logger.warning(f"AD connection failed, rebinding: {e}")
+            client.rebind()
+            return func(client)
 
 
 class ADError(Exception):
     pass
+
+
+class ADConnectionError(ADError):
+    pass
@@ -7,7 +7,7 @@ from ezconfig import (
     ReadableFromVault,
     init_settings_multienv,
 )
-from pydantic import BaseModel, SecretStr, field_validator
+from pydantic import AliasChoices, BaseModel, Field, SecretStr, field_validator
 
 
 class DbSecrets(BaseModel):
@@ -25,10 +25,23 @@ class ExternalDBSecrets(BaseModel):
 
 
 class ADSecrets(BaseModel):
-    url: str
+    # Список контроллеров домена, для совместимости принимается и одиночный url
+    urls: Annotated[list[str], Field(validation_alias=AliasChoices("urls", "url"))]
     user: SecretStr
     password: SecretStr
 
+    @field_validator("urls", mode="before")
+    @classmethod
+    def url_to_list(cls, urls: str | list[str]) -> list[str]:
+        return [urls] if isinstance(urls, str) else urls
+
+    @field_validator("urls")
+    @classmethod
+    def require_urls(cls, urls: list[str]) -> list[str]:
+        if not urls:
+            raise ValueError("at least one AD server url is required")
+        return urls
+
 
 class SMTPSecrets(BaseModel):
     hostname: str
@@ -37,6 +50,59 @@ class SMTPSecrets(BaseModel):
     password: SecretStr
 
 
+class SMTPPoolSettings(BaseModel):
+    size: int
+    max_messages_per_connection: int
+
+
+class ExternalDBSyncSettings(BaseModel):
+    chunk_size: int
+    incremental: bool
+    full_resync_interval_days: int
+
+
+class ADSyncSettings(BaseModel):
+    pool_size: int
+    parallel_servers: int
+    server_retry_after_seconds: int
+    batch_size: int
+    snapshot_page_size: int
+    snapshot_min_ratio: float
+    incremental: bool
+    max_refresh_interval_days: int
+    write_chunk_size: int
+
+
+NotificationChannel = Literal["email", "portals"]
+
+
+class ChannelLimitSettings(BaseModel):
+    initial_concurrency: int
+    max_concurrency: int
+    target_latency_seconds: float
+    max_rps: float | None = None
+
+
+class NotificationSettings(BaseModel):
+    max_concurrency: int
+    channel_limits: dict[NotificationChannel, ChannelLimitSettings]
+    portal_batch_size: int
+    outbox_workers: int
+    outbox_batch_size: int
+    outbox_max_attempts: int
+    outbox_retry_after_minutes: int
+    outbox_lease_minutes: int
+    retry_attempts: int
+    retry_base_delay_seconds: float
+    retry_max_delay_seconds: float
+    breaker_failure_threshold: int
+
+
+class PipelineSettings(BaseModel):
+    enabled: bool
+    queue_size: int
+
+
 class DebugFeatures(BaseModel):
     run_immediately: bool
     enable_sqlalchemy_logs: bool
@@ -60,23 +126,30 @@ class AppSettings(EzconfigPydanticSettings):
     externaldb_secrets: Annotated[ExternalDBSecrets, ReadableFromVault]
     externaldb_group_names_to_include: list[str]
     externaldb_group_names_to_exclude: list[str]
+    externaldb_sync: ExternalDBSyncSettings
 
     active_directory: Annotated[ADSecrets, ReadableFromVault]
     search_base: str
+    ad_sync: ADSyncSettings
 
     debug: DebugFeatures
 
     smtp_sender_name: str
     smtp_secrets: Annotated[SMTPSecrets, ReadableFromVault]
+    smtp_pool: SMTPPoolSettings
 
     schedule_main: str
+    schedule_resend_deferred: str
+    pipeline: PipelineSettings
     notify_at_days_to_expiry: list[int]
+    notification: NotificationSettings
 
     email_subject: str
     email_content_html: str
     email_content_plain: str
     portal_title: str
     portal_summary: str
+    portal_content: str
 
     @field_validator("notify_at_days_to_expiry")
     @classmethod
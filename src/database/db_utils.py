@@ -1,4 +1,5 @@
 from loguru import logger
+from sqlalchemy import Connection, inspect, literal, text
 
 import src.database.models  # noqa: F401
 from src.database import Base, db_engine_manager
@@ -8,6 +9,38 @@ async def prepare_databse() -> None:
     logger.info("Creating tables, if required")
     async with db_engine_manager.get_engine().begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(_add_missing_columns)
+
+
+def _add_missing_columns(conn: Connection) -> None:
+    """
+    create_all не меняет уже существующие таблицы, поэтому новые колонки
+    (и индексы по ним) добавляются отдельно
+    """
+    inspector = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+        missing_columns = [
+            column for column in table.columns if column.name not in existing_columns
+        ]
+
+        for column in missing_columns:
+            logger.info(f"Adding column {table.name}.{column.name}")
+            ddl = f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column.type.compile(conn.dialect)}'
+            if column.computed is not None:
+                ddl += f" GENERATED ALWAYS AS ({column.computed.sqltext}) STORED"
+            elif column.default is not None and column.default.is_scalar:
+                default = literal(column.default.arg, column.type).compile(
+                    dialect=conn.dialect, compile_kwargs={"literal_binds": True}
+                )
+                ddl += f" DEFAULT {default}"
+            if not column.nullable:
+                ddl += " NOT NULL"
+            conn.execute(text(ddl))
+
+        if missing_columns:
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
 
 
 async def purge_database() -> None:
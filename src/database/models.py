@@ -1,8 +1,9 @@
 from __future__ import annotations
 
-from datetime import datetime, time, timedelta
+from collections.abc import Iterable
+from datetime import date, datetime, time, timedelta
 
-from sqlalchemy import DateTime
+from sqlalchemy import ColumnElement, Computed, Date, DateTime, ForeignKey, Index, and_
 from sqlalchemy.orm import Mapped, mapped_column
 
 from src.database import Base
@@ -10,6 +11,19 @@ from src.utils import MSK
 
 LONG_AGO = datetime(1970, 1, 1, tzinfo=MSK)
 
+# Пароль, истекающий до 09:00 по МСК, считается истекающим накануне.
+# Выражение должно совпадать с get_pwd_expiry_date и RunContext.days_to_expiry
+_PWD_EXPIRY_DATE_SQL = (
+    "(timezone(interval '3 hours', ad_pwd_expiry) - interval '9 hours 1 microsecond')::date"
+)
+
+
+def get_pwd_expiry_date(pwd_expiry: datetime) -> date:
+    expiry_date = pwd_expiry.astimezone(MSK).date()
+    if pwd_expiry.astimezone(MSK).time() <= time(hour=9, minute=0):
+        expiry_date -= timedelta(days=1)
+    return expiry_date
+
 
 class DBUser(Base):
     __tablename__ = "user"
@@ -20,23 +34,104 @@ class DBUser(Base):
     externaldb_fio: Mapped[str]
     externaldb_group: Mapped[str]
     externaldb_email: Mapped[str]
+    # SHA-256 полей во внешней БД, по нему определяются изменившиеся строки
+    externaldb_checksum: Mapped[bytes | None] = mapped_column(default=None, kw_only=True)
 
     ad_login: Mapped[str]
     ad_disabled: Mapped[bool] = mapped_column(default=False)
     ad_pwd_expiry: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), default=None)
     ad_pwd_expired: Mapped[bool] = mapped_column(default=False)
+    # Вычисляется в БД из ad_pwd_expiry, по нему отбираются пользователи для уведомлений
+    ad_pwd_expiry_date: Mapped[date | None] = mapped_column(
+        Date, Computed(_PWD_EXPIRY_DATE_SQL, persisted=True), index=True, init=False
+    )
 
     last_ad_refresh: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=LONG_AGO)
     last_notification: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=LONG_AGO)
+    next_refresh_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), default=LONG_AGO, index=True
+    )
+
+    @classmethod
+    def expires_in_days(cls, days: Iterable[int], today: date) -> ColumnElement[bool]:
+        """
+        Условие для выборки пользователей, чей пароль истекает через одно из days дней
+        """
+        return and_(
+            cls.ad_pwd_expiry_date.in_([today + timedelta(days=n) for n in days]),
+            ~cls.ad_disabled,
+            ~cls.ad_pwd_expired,
+        )
+
+
+class DBSyncState(Base):
+    """
+    Отметки синхронизаций с внешними системами (high-water mark и т.п.)
+    """
+
+    __tablename__ = "sync_state"
+
+    name: Mapped[str] = mapped_column(primary_key=True)
+    source: Mapped[str]
+    watermark: Mapped[str]
+    updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True))
+
 
-    @property
-    def ad_pwd_expires_in_days(self) -> int | None:
-        if not self.ad_pwd_expiry or self.ad_disabled or self.ad_pwd_expired:
-            return None
+class DBGroup(Base):
+    """
+    Копия дерева групп внешней БД (dbo.UserGroups)
+    """
 
-        expiry_date = self.ad_pwd_expiry.astimezone(MSK).date()
-        if self.ad_pwd_expiry.astimezone(MSK).time() <= time(hour=9, minute=0):
-            expiry_date -= timedelta(days=1)
+    __tablename__ = "externaldb_group"
 
-        now_date = datetime.now(MSK).date()
-        return (expiry_date - now_date).days
+    id: Mapped[str] = mapped_column(primary_key=True)
+    full_name: Mapped[str] = mapped_column(index=True)
+    parent_id: Mapped[str | None]
+
+
+class DBGroupClosure(Base):
+    """
+    Таблица замыкания дерева групп: все пары (предок, потомок), включая саму группу с depth=0
+    """
+
+    __tablename__ = "externaldb_group_closure"
+
+    ancestor_id: Mapped[str] = mapped_column(primary_key=True)
+    descendant_id: Mapped[str] = mapped_column(primary_key=True, index=True)
+    depth: Mapped[int]
+
+
+class DBNotificationOutbox(Base):
+    """
+    Очередь уведомлений: строка на (пользователь, канал, дата истечения, порог).
+    Уникальность по этим полям служит ключом идемпотентности - повторная постановка
+    в очередь в тот же день ничего не добавляет
+    """
+
+    __tablename__ = "notification_outbox"
+    __table_args__ = (
+        Index(
+            "uq_notification_outbox_idempotency",
+            "user_id",
+            "channel",
+            "expiry_date",
+            "days_to_expiry",
+            unique=True,
+        ),
+        Index(
+            "ix_notification_outbox_pending", "channel", "id", postgresql_where="status = 'pending'"
+        ),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True, init=False)
+    user_id: Mapped[int] = mapped_column(ForeignKey("user.id", ondelete="CASCADE"))
+    channel: Mapped[str]
+    expiry_date: Mapped[date]
+    days_to_expiry: Mapped[int]
+    # pending -> sent | failed
+    status: Mapped[str] = mapped_column(default="pending")
+    attempts: Mapped[int] = mapped_column(default=0)
+    # Строка не берется в работу до этого времени: пока ее отправляет воркер (аренда)
+    # или пока не пришло время повторить отложенное из-за временной ошибки уведомление
+    available_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=LONG_AGO)
+    sent_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), default=None)
@@ -0,0 +1,67 @@
+"""
+Легкие проекции строк для массовых выборок. В отличие от DBUser они не попадают
+в identity map сессии и не отслеживают изменения: выбираются только нужные столбцы,
+а изменения записываются явными UPDATE
+"""
+
+from dataclasses import dataclass
+from datetime import datetime
+
+from sqlalchemy import Select, select
+
+from src.database.models import DBNotificationOutbox, DBUser
+
+
+@dataclass(frozen=True, slots=True)
+class UserToRefresh:
+    """
+    Пользователь, данные которого нужно перечитать из AD
+    """
+
+    id: int
+    ad_login: str
+
+    @staticmethod
+    def select() -> Select[tuple[int, str]]:
+        return select(DBUser.id, DBUser.ad_login)
+
+
+@dataclass(frozen=True, slots=True)
+class UserToNotify:
+    """
+    Пользователь, которому отправляется уведомление
+    """
+
+    id: int
+    externaldb_id: str
+    externaldb_fio: str
+    externaldb_group: str
+    externaldb_email: str
+    ad_login: str
+    ad_disabled: bool
+    ad_pwd_expiry: datetime | None
+    ad_pwd_expired: bool
+
+    @staticmethod
+    def select() -> Select[tuple[int, str, str, str, str, str, bool, datetime | None, bool]]:
+        return select(
+            DBUser.id,
+            DBUser.externaldb_id,
+            DBUser.externaldb_fio,
+            DBUser.externaldb_group,
+            DBUser.externaldb_email,
+            DBUser.ad_login,
+            DBUser.ad_disabled,
+            DBUser.ad_pwd_expiry,
+            DBUser.ad_pwd_expired,
+        )
+
+
+@dataclass(frozen=True, slots=True)
+class OutboxRow:
+    id: int
+    user_id: int
+
+    @staticmethod
+    def select() -> Select[tuple[int, int]]:
+        return select(DBNotificationOutbox.id, DBNotificationOutbox.user_id)
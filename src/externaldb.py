@@ -1,21 +1,165 @@
-from dataclasses import dataclass
+import asyncio
+from collections.abc import AsyncIterator, Generator
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, astuple, dataclass
+from datetime import datetime, timedelta
+from typing import Any, TypeVar
 
 from loguru import logger
-from sqlalchemy import URL, create_engine, delete, select, text
+from sqlalchemy import (
+    URL,
+    Column,
+    LargeBinary,
+    MetaData,
+    String,
+    Table,
+    case,
+    create_engine,
+    delete,
+    exists,
+    insert,
+    literal_column,
+    select,
+    text,
+    tuple_,
+)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import aliased
 from sqlalchemy.pool import NullPool
+from sqlalchemy.sql.dml import ReturningInsert
 
+from src import metrics
 from src.config import settings
 from src.database import db_sessionmaker
-from src.database.models import DBUser
+from src.database.models import LONG_AGO, DBGroup, DBGroupClosure, DBSyncState, DBUser
+from src.utils import MSK
 
+T = TypeVar("T")
 
-@dataclass
+
+@dataclass(slots=True, frozen=True)
 class ExternalDBUser:
     id: str
     fio: str
     group: str
     email: str
     ad_login: str
+    checksum: bytes
+
+
+@dataclass(slots=True, frozen=True)
+class ExternalDBGroup:
+    id: str
+    full_name: str
+    parent_id: str | None
+
+
+@dataclass
+class SyncStats:
+    inserted: int = 0
+    updated: int = 0
+    deleted: int = 0
+    unchanged: int = 0
+
+
+_staging_table = Table(
+    "externaldb_staging",
+    MetaData(),
+    Column("externaldb_id", String),
+    Column("externaldb_fio", String),
+    Column("externaldb_group", String),
+    Column("externaldb_email", String),
+    Column("ad_login", String),
+    Column("externaldb_checksum", LargeBinary),
+)
+_checksums_staging_table = Table(
+    "externaldb_checksums_staging",
+    MetaData(),
+    Column("externaldb_id", String),
+    Column("externaldb_checksum", LargeBinary),
+)
+
+# Промежуточные таблицы заполняются короткими транзакциями по мере чтения внешней БД,
+# поэтому они обычные (не TEMP, которые живут в одном подключении). UNLOGGED - их содержимое
+# не нужно после перезапуска Postgres. Таблицы пересоздаются при каждом запуске, чтобы
+# не зависеть от оставшихся с прошлого раза. Синхронизация не запускается параллельно сама с собой
+_CREATE_STAGING_TABLES = [
+    """
+    CREATE UNLOGGED TABLE externaldb_staging (
+        externaldb_id text NOT NULL,
+        externaldb_fio text NOT NULL,
+        externaldb_group text NOT NULL,
+        externaldb_email text NOT NULL,
+        ad_login text NOT NULL,
+        externaldb_checksum bytea NOT NULL
+    )
+    """,
+    """
+    CREATE UNLOGGED TABLE externaldb_checksums_staging (
+        externaldb_id text NOT NULL,
+        externaldb_checksum bytea NOT NULL
+    )
+    """,
+]
+_DROP_STAGING_TABLES = "DROP TABLE IF EXISTS externaldb_staging, externaldb_checksums_staging"
+
+
+def _build_upsert() -> ReturningInsert[tuple[bool]]:
+    """
+    INSERT ... ON CONFLICT, который обновляет только действительно изменившиеся строки.
+    Возвращает для каждой вставленной/обновленной строки, была ли она вставлена
+    """
+    users = DBUser.__table__
+    columns = [column.name for column in _staging_table.columns]
+    # DISTINCT ON защищает от повторов id: ON CONFLICT не может обновить строку дважды
+    source = select(_staging_table).distinct(_staging_table.c.externaldb_id)
+
+    stmt = pg_insert(users).from_select(columns, source)
+    updated_columns = [
+        "externaldb_fio",
+        "externaldb_group",
+        "externaldb_email",
+        "ad_login",
+        "externaldb_checksum",
+    ]
+    return stmt.on_conflict_do_update(
+        index_elements=[users.c.externaldb_id],
+        set_={
+            **{name: stmt.excluded[name] for name in updated_columns},
+            # Для сменившегося логина данные из AD нужно перечитать
+            "next_refresh_at": case(
+                (users.c.ad_login != stmt.excluded.ad_login, LONG_AGO),
+                else_=users.c.next_refresh_at,
+            ),
+        },
+        where=tuple_(*(users.c[name] for name in updated_columns)).is_distinct_from(
+            tuple_(*(stmt.excluded[name] for name in updated_columns))
+        ),
+    ).returning(literal_column("xmax = 0"))
+
+
+def build_group_closure(groups: list[ExternalDBGroup]) -> list[tuple[str, str, int]]:
+    """
+    Строит таблицу замыкания (предок, потомок, глубина) по списку групп с родителями
+    """
+    parents = {group.id: group.parent_id for group in groups}
+    closure: list[tuple[str, str, int]] = []
+    for group in groups:
+        ancestor_id: str | None = group.id
+        depth = 0
+        visited: set[str] = set()
+        # visited защищает от циклов в кривых данных
+        while ancestor_id is not None and ancestor_id in parents and ancestor_id not in visited:
+            visited.add(ancestor_id)
+            closure.append((ancestor_id, group.id, depth))
+            ancestor_id = parents[ancestor_id]
+            depth += 1
+    return closure
+
+
+_GROUPS_STATE_NAME = "externaldb_groups"
+_USERS_STATE_NAME = "externaldb_users"
+_FULL_SYNC_STATE_NAME = "externaldb_full_sync"
 
 
 class ExternalDBSyncer:
@@ -25,62 +169,266 @@ class ExternalDBSyncer:
 
     def __init__(self) -> None:
         self._externaldb = ExternalDBClient()
+        self._chunk_size = settings.externaldb_sync.chunk_size
+        self._groups_to_include = settings.externaldb_group_names_to_include
+        self._groups_to_exclude = settings.externaldb_group_names_to_exclude
+        self._incremental = settings.externaldb_sync.incremental
+        self._full_resync_interval = timedelta(
+            days=settings.externaldb_sync.full_resync_interval_days
+        )
 
     def test_connection(self) -> None:
         self._externaldb.test_connection()
 
     async def sync(self) -> None:
+        """
+        Выгружает пользователей внешней БД в промежуточную таблицу через COPY, после чего
+        одним INSERT ... ON CONFLICT применяет изменения и одним DELETE удаляет лишних.
+        В инкрементальном режиме из внешней БД забираются только строки с изменившейся
+        контрольной суммой, а для поиска удаленных - только список id с суммами.
+        Каждая пачка копируется своей короткой транзакцией, и подключение к Postgres
+        не занято, пока читается внешняя БД. Изменения в user применяются одной транзакцией
+        после окончания чтения, поэтому ошибка чтения внешней БД ничего не удаляет
+        """
         logger.info("Syncing with external DB")
 
-        externaldb_users = self._externaldb.get_users()
+        group_ids = await self._get_group_ids()
 
+        loop = asyncio.get_running_loop()
+        users_checksum = await loop.run_in_executor(
+            None, self._externaldb.get_users_checksum, group_ids
+        )
         async with db_sessionmaker() as session:
-            users_result = await session.scalars(select(DBUser))
-            users = {user.externaldb_id: user for user in users_result}
-
-        logger.info(f"Currently {len(users)} users in DB")
-        updated_users: list[DBUser] = []
-
-        for externaldb_user in externaldb_users:
-            user = users.get(externaldb_user.id)
-            if user:
-                user.externaldb_fio = externaldb_user.fio
-                user.externaldb_group = externaldb_user.group
-                user.externaldb_email = externaldb_user.email
-                user.ad_login = externaldb_user.ad_login
-            else:
-                user = DBUser(
-                    externaldb_id=externaldb_user.id,
-                    externaldb_fio=externaldb_user.fio,
-                    externaldb_group=externaldb_user.group,
-                    externaldb_email=externaldb_user.email,
-                    ad_login=externaldb_user.ad_login,
+            users_state = await session.get(DBSyncState, _USERS_STATE_NAME)
+            full_sync_state = await session.get(DBSyncState, _FULL_SYNC_STATE_NAME)
+
+        now = datetime.now(MSK)
+        full_sync = (
+            not self._incremental
+            or not full_sync_state
+            or now - full_sync_state.updated_at >= self._full_resync_interval
+        )
+        if not full_sync and users_state and users_state.watermark == users_checksum:
+            logger.success("External DB users have not changed since the last sync")
+            return
+
+        async with db_sessionmaker.begin() as session:
+            await session.execute(text(_DROP_STAGING_TABLES))
+            for create_table in _CREATE_STAGING_TABLES:
+                await session.execute(text(create_table))
+
+        if full_sync:
+            logger.info("Running full sync with external DB")
+            pulled = await self._stage_users(group_ids)
+            ids_table = _staging_table
+        else:
+            logger.info("Running incremental sync with external DB")
+            pulled = await self._stage_changed_users(group_ids)
+            ids_table = _checksums_staging_table
+
+        stats = SyncStats()
+        async with db_sessionmaker.begin() as session:
+            conn = await session.connection()
+            upsert_result = await conn.execute(_build_upsert())
+            for (inserted,) in upsert_result:
+                if inserted:
+                    stats.inserted += 1
+                else:
+                    stats.updated += 1
+
+            delete_result = await conn.execute(
+                delete(DBUser).where(
+                    ~exists().where(ids_table.c.externaldb_id == DBUser.externaldb_id)
+                )
+            )
+            stats.deleted = delete_result.rowcount
+
+            await session.merge(
+                DBSyncState(
+                    name=_USERS_STATE_NAME,
+                    source="dbo.Users",
+                    watermark=users_checksum,
+                    updated_at=now,
                 )
-            updated_users.append(user)
+            )
+            if full_sync:
+                await session.merge(
+                    DBSyncState(
+                        name=_FULL_SYNC_STATE_NAME,
+                        source="dbo.Users",
+                        watermark=users_checksum,
+                        updated_at=now,
+                    )
+                )
+            await conn.execute(text(_DROP_STAGING_TABLES))
 
-        required_externaldb_ids = [externaldb_user.id for externaldb_user in externaldb_users]
-        ids_to_delete = [
-            user.externaldb_id
-            for user in users.values()
-            if user.externaldb_id not in required_externaldb_ids
-        ]
+        stats.unchanged = pulled - stats.inserted - stats.updated
+        self._report(stats)
+        logger.success("Done syncing with external DB")
+
+    async def _stage_users(self, group_ids: list[str], user_ids: list[str] | None = None) -> int:
+        pulled = 0
+        chunks = self._externaldb.iter_users(group_ids, self._chunk_size, user_ids)
+        async for externaldb_users in self._iter_in_thread(chunks):
+            await self._copy_to_staging(
+                _staging_table, [astuple(externaldb_user) for externaldb_user in externaldb_users]
+            )
+            pulled += len(externaldb_users)
+        logger.info(f"Pulled {pulled} users from external DB")
+        return pulled
+
+    async def _stage_changed_users(self, group_ids: list[str]) -> int:
+        """
+        Загружает список (id, контрольная сумма), после чего забирает полностью
+        только новых и изменившихся пользователей. Возвращает общее число пользователей
+        """
+        checked = 0
+        chunks = self._externaldb.iter_user_checksums(group_ids, self._chunk_size)
+        async for checksums in self._iter_in_thread(chunks):
+            await self._copy_to_staging(_checksums_staging_table, checksums)
+            checked += len(checksums)
+
+        users = DBUser.__table__
+        async with db_sessionmaker() as session:
+            changed_result = await session.scalars(
+                select(_checksums_staging_table.c.externaldb_id)
+                .outerjoin(users, users.c.externaldb_id == _checksums_staging_table.c.externaldb_id)
+                .where(
+                    users.c.externaldb_checksum.is_distinct_from(
+                        _checksums_staging_table.c.externaldb_checksum
+                    )
+                )
+            )
+            changed_ids = list(changed_result)
+        logger.info(f"{len(changed_ids)} of {checked} external DB users are new or changed")
+
+        for i in range(0, len(changed_ids), self._chunk_size):
+            await self._stage_users(group_ids, changed_ids[i : i + self._chunk_size])
+        return checked
+
+    async def _copy_to_staging(self, table: Table, records: list[tuple[Any, ...]]) -> None:
+        async with db_sessionmaker.begin() as session:
+            conn = await session.connection()
+            driver_conn = (await conn.get_raw_connection()).driver_connection
+            await driver_conn.copy_records_to_table(
+                table.name, records=records, columns=[column.name for column in table.columns]
+            )
+
+    def _report(self, stats: SyncStats) -> None:
+        logger.info(
+            f"External DB sync: {stats.inserted} inserted, {stats.updated} updated, "
+            f"{stats.deleted} deleted, {stats.unchanged} unchanged"
+        )
+        for kind, count in asdict(stats).items():
+            metrics.externaldb_sync_rows.labels(kind).inc(count)
+
+    async def _get_group_ids(self) -> list[str]:
+        """
+        Раскрывает включенные и исключенные группы по закэшированному дереву групп.
+        Дерево перечитывается из внешней БД, только если изменилась контрольная сумма dbo.UserGroups
+        """
+        loop = asyncio.get_running_loop()
+        checksum = await loop.run_in_executor(None, self._externaldb.get_groups_checksum)
+
+        async with db_sessionmaker() as session:
+            groups_state = await session.get(DBSyncState, _GROUPS_STATE_NAME)
+
+        if not groups_state or groups_state.watermark != checksum:
+            groups = await loop.run_in_executor(None, self._externaldb.get_groups)
+            await self._save_group_tree(groups, checksum)
 
+        ancestor = aliased(DBGroup)
+        path = aliased(DBGroupClosure)
+        path_rest = aliased(DBGroupClosure)
+        excluded = aliased(DBGroup)
+        # Группа подходит, если она лежит под включенной группой и на пути от нее
+        # (не считая саму включенную группу) нет исключенных групп
+        stmt = (
+            select(DBGroupClosure.descendant_id)
+            .distinct()
+            .join(ancestor, ancestor.id == DBGroupClosure.ancestor_id)
+            .where(
+                ancestor.full_name.in_(self._groups_to_include),
+                ~exists().where(
+                    path.ancestor_id == DBGroupClosure.ancestor_id,
+                    path.depth > 0,
+                    path_rest.ancestor_id == path.descendant_id,
+                    path_rest.descendant_id == DBGroupClosure.descendant_id,
+                    excluded.id == path.descendant_id,
+                    excluded.full_name.in_(self._groups_to_exclude),
+                ),
+            )
+        )
         async with db_sessionmaker() as session:
-            logger.info(f"Updating/adding {len(updated_users)} users")
-            session.add_all(updated_users)
-            await session.commit()
+            result = await session.scalars(stmt)
+            group_ids = list(result)
+
+        logger.info(f"Resolved {len(group_ids)} groups to sync users from")
+        return group_ids
 
-            if ids_to_delete:
-                logger.info(
-                    f"Deleting {len(ids_to_delete)} users that are no longer in external DB"
+    async def _save_group_tree(self, groups: list[ExternalDBGroup], checksum: str) -> None:
+        closure = build_group_closure(groups)
+        logger.info(f"Caching {len(groups)} groups ({len(closure)} closure rows) from external DB")
+
+        async with db_sessionmaker.begin() as session:
+            await session.execute(delete(DBGroupClosure))
+            await session.execute(delete(DBGroup))
+            if groups:
+                await session.execute(insert(DBGroup), [asdict(group) for group in groups])
+            if closure:
+                await session.execute(
+                    insert(DBGroupClosure),
+                    [
+                        {"ancestor_id": ancestor_id, "descendant_id": descendant_id, "depth": depth}
+                        for ancestor_id, descendant_id, depth in closure
+                    ],
                 )
-                delete_result = await session.execute(
-                    delete(DBUser).where(DBUser.externaldb_id.in_(ids_to_delete))
+            await session.merge(
+                DBSyncState(
+                    name=_GROUPS_STATE_NAME,
+                    source="dbo.UserGroups",
+                    watermark=checksum,
+                    updated_at=datetime.now(MSK),
                 )
-                await session.commit()
-                logger.info(f"Deleted {delete_result.rowcount} users from DB")
+            )
 
-        logger.success("Done syncing with external DB")
+    async def _iter_in_thread(
+        self, chunks: Generator[list[T], None, None]
+    ) -> AsyncIterator[list[T]]:
+        """
+        Читает пачки из блокирующего генератора. Вызовы pymssql выполняются
+        в отдельном потоке, чтобы не останавливать event loop
+        """
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(1, thread_name_prefix="externaldb") as executor:
+            try:
+                while chunk := await loop.run_in_executor(executor, next, chunks, None):
+                    yield chunk
+            finally:
+                await loop.run_in_executor(executor, chunks.close)
+
+
+# Списки id передаются одной строкой, чтобы не упереться в лимит параметров MSSQL
+_USERS_FROM = """
+    FROM dbo.Users u
+    JOIN dbo.UserGroups ug ON u.UserGroupId = ug.Id
+    JOIN aggregatetables.dbo.users u1 ON u.Id = u1.userid
+    WHERE u.IsDeleted=0 AND u1.AD IS NOT NULL
+        AND u.UserGroupId IN (SELECT value FROM STRING_SPLIT(:group_ids, ','))
+"""
+# Поля разделены символом, которого нет в данных, чтобы ("ab", "c") и ("a", "bc") различались
+_USER_CHECKSUM = """
+    HASHBYTES('SHA2_256', CONCAT(u1.fio, CHAR(31), ug.FullName, CHAR(31), u.Email, CHAR(31), u1.AD))
+    AS Checksum
+"""
+_USERS_QUERY = f"""
+    SELECT DISTINCT u.id, u1.fio, ug.FullName as GroupName, u.Email, u1.AD, {_USER_CHECKSUM}
+    {_USERS_FROM}
+"""
+_USER_CHECKSUMS_QUERY = f"""
+    SELECT DISTINCT u.id, {_USER_CHECKSUM}
+    {_USERS_FROM}
+"""
 
 
 class ExternalDBClient:
@@ -103,50 +451,98 @@ class ExternalDBClient:
             echo=settings.debug.enable_sqlalchemy_logs,
             poolclass=NullPool,
         )
-        self._groups_to_include = settings.externaldb_group_names_to_include
-        self._groups_to_exclude = settings.externaldb_group_names_to_exclude
 
     def test_connection(self) -> None:
         logger.info("Testing external DB connection")
         with self._engine.connect() as conn:
             conn.execute(text("SELECT 1"))
 
-    def get_users(self) -> list[ExternalDBUser]:
+    def get_groups_checksum(self) -> str:
+        """
+        Дешевая проверка, изменилось ли дерево групп
+        """
         stmt = text("""
-            WITH RecursiveGroups AS (
-                SELECT ug.id, ug.FullName, ug.ParentUserGroupId
-                FROM dbo.UserGroups ug
-                WHERE ug.FullName in :groups_names_to_include
-                UNION ALL
-                SELECT ug.id, ug.FullName, ug.ParentUserGroupId
-                FROM RecursiveGroups rg JOIN dbo.UserGroups ug ON rg.id = ug.ParentUserGroupId
-                WHERE ug.FullName NOT IN :groups_names_to_exclude
-            )
-            SELECT DISTINCT u.id, u1.fio, rg.FullName as GroupName, u.Email, u1.AD
-            FROM dbo.Users u
-            JOIN RecursiveGroups rg ON u.UserGroupId = rg.Id
-            JOIN aggregatetables.dbo.users u1 ON u.Id = u1.userid
-            WHERE u.IsDeleted=0 AND u1.AD IS NOT NULL
+            SELECT COUNT_BIG(*) AS Count,
+                   CHECKSUM_AGG(BINARY_CHECKSUM(ug.Id, ug.FullName, ug.ParentUserGroupId)) AS Checksum
+            FROM dbo.UserGroups ug
         """)
-        stmt = stmt.bindparams(
-            groups_names_to_include=self._groups_to_include,
-            # Пустой  список в groups_to_exclude вызвывает ошибку SQL, для этого дефолтное значение
-            groups_names_to_exclude=self._groups_to_exclude or [""],
-        )
+        with self._engine.connect() as conn:
+            row = conn.execute(stmt).one()
+        return f"{row.Count}:{row.Checksum}"
 
-        logger.info("Requesting users from external DB")
+    def get_groups(self) -> list[ExternalDBGroup]:
+        logger.info("Requesting user groups from external DB")
+        stmt = text("SELECT ug.Id, ug.FullName, ug.ParentUserGroupId FROM dbo.UserGroups ug")
         with self._engine.connect() as conn:
-            result = conn.execute(stmt)
-            users = list(result.all())
-        logger.info(f"Pulled {len(users)} users from external DB")
+            rows = conn.execute(stmt).all()
 
         return [
-            ExternalDBUser(
-                id=str(user.id),
-                fio=str(user.fio),
-                group=str(user.GroupName),
-                email=user.Email or "",
-                ad_login=user.AD,
+            ExternalDBGroup(
+                id=str(row.Id),
+                full_name=str(row.FullName),
+                parent_id=None if row.ParentUserGroupId is None else str(row.ParentUserGroupId),
             )
-            for user in users
+            for row in rows
         ]
+
+    def get_users_checksum(self, group_ids: list[str]) -> str:
+        """
+        Дешевая проверка, изменились ли пользователи из групп group_ids.
+        SHA-256 считается по упорядоченному списку пар (id, сумма строки), поэтому,
+        в отличие от CHECKSUM_AGG, не пропускает взаимно компенсирующиеся изменения
+        """
+        # varchar(max), чтобы STRING_AGG не упирался в 8000 байт
+        stmt = text(f"""
+            SELECT COUNT_BIG(*) AS Count,
+                   CONVERT(char(64), HASHBYTES('SHA2_256', STRING_AGG(
+                       CONVERT(varchar(max), CONCAT(s.id, ':', CONVERT(char(64), s.Checksum, 2))), ','
+                   ) WITHIN GROUP (ORDER BY s.id)), 2) AS Checksum
+            FROM ({_USER_CHECKSUMS_QUERY}) s
+        """).bindparams(group_ids=",".join(group_ids))
+        with self._engine.connect() as conn:
+            row = conn.execute(stmt).one()
+        return f"{row.Count}:{row.Checksum}"
+
+    def iter_user_checksums(
+        self, group_ids: list[str], chunk_size: int
+    ) -> Generator[list[tuple[str, bytes]], None, None]:
+        """
+        Отдает пачками пары (id, контрольная сумма полей) пользователей из групп group_ids
+        """
+        stmt = text(_USER_CHECKSUMS_QUERY).bindparams(group_ids=",".join(group_ids))
+
+        logger.info("Requesting user checksums from external DB")
+        with self._engine.connect() as conn:
+            result = conn.execution_options(stream_results=True, yield_per=chunk_size).execute(stmt)
+            for rows in result.partitions():
+                yield [(str(row.id), row.Checksum) for row in rows]
+
+    def iter_users(
+        self, group_ids: list[str], chunk_size: int, user_ids: list[str] | None = None
+    ) -> Generator[list[ExternalDBUser], None, None]:
+        """
+        Отдает пользователей из групп group_ids (и только user_ids, если передан)
+        пачками по chunk_size, не загружая весь результат в память
+        """
+        query = _USERS_QUERY
+        if user_ids is not None:
+            query += "AND u.Id IN (SELECT value FROM STRING_SPLIT(:user_ids, ','))"
+        stmt = text(query).bindparams(group_ids=",".join(group_ids))
+        if user_ids is not None:
+            stmt = stmt.bindparams(user_ids=",".join(user_ids))
+
+        logger.info("Requesting users from external DB")
+        with self._engine.connect() as conn:
+            result = conn.execution_options(stream_results=True, yield_per=chunk_size).execute(stmt)
+            for rows in result.partitions():
+                yield [
+                    ExternalDBUser(
+                        id=str(row.id),
+                        fio=str(row.fio),
+                        group=str(row.GroupName),
+                        email=row.Email or "",
+                        ad_login=row.AD,
+                        checksum=row.Checksum,
+                    )
+                    for row in rows
+                ]
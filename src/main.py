@@ -13,6 +13,7 @@ from src.database import db_engine_manager
 from src.database.db_utils import prepare_databse
 from src.externaldb import ExternalDBSyncer
 from src.notification.notificator import Notificator
+from src.pipeline import run_pipelined, run_sequential
 from src.utils import http_session_manager
 
 externaldb_syncer = ExternalDBSyncer()
@@ -39,9 +40,10 @@ async def async_main() -> None:
 async def sync_and_notify() -> None:
     metrics.runs.inc()
 
-    await externaldb_syncer.sync()
-    await ad_syncer.sync()
-    await notificator.send_all()
+    if settings.pipeline.enabled:
+        await run_pipelined(externaldb_syncer, ad_syncer, notificator)
+    else:
+        await run_sequential(externaldb_syncer, ad_syncer, notificator)
 
 
 async def run_scheduler() -> None:
@@ -53,6 +55,11 @@ async def run_scheduler() -> None:
         trigger=CronTrigger.from_crontab(settings.schedule_main),
         misfire_grace_time=60,
     )
+    scheduler.add_job(
+        func=notificator.resend_deferred,
+        trigger=CronTrigger.from_crontab(settings.schedule_resend_deferred),
+        misfire_grace_time=60,
+    )
 
     logger.info("Running scheduler forever")
     scheduler.start()
@@ -1,5 +1,5 @@
 from loguru import logger
-from prometheus_client import Counter, start_http_server
+from prometheus_client import Counter, Gauge, start_http_server
 
 _NAMESPACE = "pwdreminder"
 
@@ -26,6 +26,74 @@ notifications_sent = Counter(
 notifications_sent.labels("email")
 notifications_sent.labels("portals")
 
+notification_circuit_open = Gauge(
+    "notification_circuit_open",
+    "Whether the circuit breaker of the notification channel is open",
+    ["channel"],
+    namespace=_NAMESPACE,
+)
+notification_circuit_open.labels("email")
+notification_circuit_open.labels("portals")
+
+notification_channel_limit = Gauge(
+    "notification_channel_limit",
+    "Current adaptive concurrency limit of the notification channel",
+    ["channel"],
+    namespace=_NAMESPACE,
+)
+
+notification_renders = Counter(
+    "notification_renders",
+    "How many notification templates were rendered",
+    namespace=_NAMESPACE,
+)
+notification_renders_per_second = Gauge(
+    "notification_renders_per_second",
+    "Template rendering throughput during the last run",
+    namespace=_NAMESPACE,
+)
+
+
+externaldb_sync_rows = Counter(
+    "externaldb_sync_rows",
+    "How many users were inserted/updated/deleted/unchanged by the external DB sync",
+    ["kind"],
+    namespace=_NAMESPACE,
+)
+for _kind in ("inserted", "updated", "deleted", "unchanged"):
+    externaldb_sync_rows.labels(_kind)
+
+ad_pool_size = Gauge(
+    "ad_pool_size",
+    "How many AD connections are bound in the pool",
+    namespace=_NAMESPACE,
+)
+ad_pool_busy = Gauge(
+    "ad_pool_busy",
+    "How many AD connections are currently executing a request",
+    namespace=_NAMESPACE,
+)
+
+ad_server_latency = Gauge(
+    "ad_server_latency_seconds",
+    "Smoothed latency of AD operations per domain controller",
+    ["server", "operation"],
+    namespace=_NAMESPACE,
+)
+ad_server_up = Gauge(
+    "ad_server_up",
+    "Whether the domain controller is considered healthy",
+    ["server"],
+    namespace=_NAMESPACE,
+)
+
+stage_duration = Gauge(
+    "stage_duration_seconds",
+    "Wall-clock duration of the last run of each stage",
+    ["stage"],
+    namespace=_NAMESPACE,
+)
+
 
 def start_server() -> None:
     logger.info("Starting metrics server")
@@ -1,7 +1,8 @@
+import asyncio
+import base64
+import uuid
 from dataclasses import dataclass
 from email.header import Header
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
 
 import aiosmtplib
 from loguru import logger
@@ -17,17 +18,103 @@ class Email:
     content_html: str
 
 
+class MessageFactory:
+    """
+    Собирает письмо multipart/alternative сразу в байты для SMTP.sendmail, без объектной
+    модели пакета email. Заголовки, общие для всех писем (отправитель, Content-Type
+    частей и т.п.), кодируются один раз при создании
+    """
+
+    def __init__(self, sender_name: str, sender_mail: str) -> None:
+        boundary = f"=_pwdreminder_{uuid.uuid4().hex}"
+        encoded_sender = Header(sender_name, "utf-8").encode(linesep="\r\n")
+        self._from = f"From: {encoded_sender} <{sender_mail}>\r\n".encode()
+        self._headers = (
+            "MIME-Version: 1.0\r\n"
+            f'Content-Type: multipart/alternative; boundary="{boundary}"\r\n'
+            "\r\n"
+        ).encode()
+        self._plain_part = self._part_headers(boundary, "plain")
+        self._html_part = self._part_headers(boundary, "html")
+        self._end = f"--{boundary}--\r\n".encode()
+
+    def build(self, email: Email) -> bytes:
+        return b"".join(
+            (
+                self._from,
+                f"To: {_check_header_value(email.recipient)}\r\n".encode(),
+                f"Subject: {self._encode_header('Subject', email.subject)}\r\n".encode(),
+                self._headers,
+                self._plain_part,
+                self._encode_body(email.content_plain),
+                self._html_part,
+                self._encode_body(email.content_html),
+                self._end,
+            )
+        )
+
+    @staticmethod
+    def _part_headers(boundary: str, subtype: str) -> bytes:
+        return (
+            f"--{boundary}\r\n"
+            f'Content-Type: text/{subtype}; charset="utf-8"\r\n'
+            "Content-Transfer-Encoding: base64\r\n"
+            "\r\n"
+        ).encode()
+
+    @staticmethod
+    def _encode_header(name: str, value: str) -> str:
+        """
+        ASCII-значение не кодируется, но, как и остальные, переносится по 78 символов
+        """
+        charset = "us-ascii" if _check_header_value(value).isascii() else "utf-8"
+        return Header(value, charset, header_name=name).encode(maxlinelen=78, linesep="\r\n")
+
+    @staticmethod
+    def _encode_body(content: str) -> bytes:
+        return base64.encodebytes(content.encode()).replace(b"\n", b"\r\n")
+
+
+def _check_header_value(value: str) -> str:
+    # Перевод строки в значении позволил бы дописать в письмо произвольные заголовки
+    if "\r" in value or "\n" in value:
+        msg = f"Header value contains a line break: {value!r}"
+        raise ValueError(msg)
+    return value
+
+
+@dataclass
+class _PooledSMTP:
+    smtp: aiosmtplib.SMTP
+    sent: int = 0
+
+
 class MailSender:
+    """
+    Отправляет письма через пул долгоживущих SMTP-подключений: рукопожатие
+    (EHLO, STARTTLS, AUTH) выполняется один раз на подключение, а не на каждое письмо
+    """
+
     def __init__(self) -> None:
-        self._smtp = aiosmtplib.SMTP(
+        self._sender_mail = settings.smtp_secrets.username.get_secret_value()
+        self._sender_name = settings.smtp_sender_name
+        self._max_messages = settings.smtp_pool.max_messages_per_connection
+        self._message_factory = MessageFactory(self._sender_name, self._sender_mail)
+
+        # Подключения открываются при первом использовании
+        self._connections = [_PooledSMTP(self._make_smtp()) for _ in range(settings.smtp_pool.size)]
+        self._pool: asyncio.Queue[_PooledSMTP] = asyncio.Queue()
+        for conn in self._connections:
+            self._pool.put_nowait(conn)
+
+    def _make_smtp(self) -> aiosmtplib.SMTP:
+        return aiosmtplib.SMTP(
             hostname=settings.smtp_secrets.hostname,
             port=settings.smtp_secrets.port,
             username=settings.smtp_secrets.username.get_secret_value(),
             password=settings.smtp_secrets.password.get_secret_value(),
             validate_certs=False,
         )
-        self._sender_mail = settings.smtp_secrets.username.get_secret_value()
-        self._sender_name = settings.smtp_sender_name
 
     async def send(self, email: Email) -> None:
         logger.debug(f"Sending email to {email.recipient}")
@@ -36,25 +123,88 @@ class MailSender:
             logger.warning(f"Email is disabled - message to '{email.recipient}' will not be sent")
             return
 
-        message = MIMEMultipart("alternative")
-        message["From"] = f"{Header(self._sender_name).encode()} <{self._sender_mail}>"
-        message["Subject"] = email.subject
-        message["To"] = email.recipient
-
-        message.attach(MIMEText(email.content_plain, "plain", "utf-8"))
-        message.attach(MIMEText(email.content_html, "html", "utf-8"))
+        try:
+            message = self._message_factory.build(email)
+        except ValueError as e:
+            raise MailSenderError(email, e) from e
 
+        conn = await self._pool.get()
         try:
-            async with self._smtp as smtp:
-                await smtp.send_message(message)
+            await self._send_pooled(conn, email.recipient, message)
         except Exception as e:
             raise MailSenderError(email, e) from e
+        finally:
+            self._pool.put_nowait(conn)
 
         logger.debug(f"Succesfully sent email to {email.recipient}")
 
+    async def close(self) -> None:
+        """
+        Закрывает все открытые подключения пула
+        """
+        for conn in self._connections:
+            await self._quit(conn)
+
+    async def _send_pooled(self, conn: _PooledSMTP, recipient: str, message: bytes) -> None:
+        try:
+            try:
+                await self._send_once(conn, recipient, message)
+            except aiosmtplib.SMTPServerDisconnected:
+                # Сервер мог закрыть простаивавшее подключение, повторяем на новом
+                logger.debug("SMTP server disconnected, reconnecting")
+                await self._send_once(conn, recipient, message)
+        except (aiosmtplib.SMTPResponseException, aiosmtplib.SMTPRecipientsRefused):
+            # Сервер отклонил письмо, подключение остается рабочим
+            raise
+        except Exception:
+            conn.smtp.close()
+            raise
+
+    async def _send_once(self, conn: _PooledSMTP, recipient: str, message: bytes) -> None:
+        await self._prepare(conn)
+        try:
+            await conn.smtp.sendmail(self._sender_mail, [recipient], message)
+        finally:
+            conn.sent += 1
+
+    async def _prepare(self, conn: _PooledSMTP) -> None:
+        if conn.sent >= self._max_messages:
+            await self._quit(conn)
+
+        if not conn.smtp.is_connected:
+            conn.sent = 0
+            await conn.smtp.connect()
+        elif conn.sent:
+            # Сбрасываем состояние транзакции после предыдущего письма
+            await conn.smtp.rset()
+
+    async def _quit(self, conn: _PooledSMTP) -> None:
+        if not conn.smtp.is_connected:
+            return
+        try:
+            await conn.smtp.quit()
+        except aiosmtplib.SMTPException:
+            conn.smtp.close()
+
 
 class MailSenderError(Exception):
     def __init__(self, email: Email, exc: Exception) -> None:
         msg = f"Error sending email to {email.recipient}: {exc!r}"
         super().__init__(msg)
         self.email = email
+        self.retriable = _is_retriable(exc)
+
+
+def _is_retriable(exc: Exception) -> bool:
+    """
+    Временные ошибки: сетевые и ответы 4xx (421, 45x). Ответы 5xx - постоянный отказ
+    """
+    if isinstance(exc, aiosmtplib.SMTPRecipientsRefused):
+        return all(_is_transient_code(recipient.code) for recipient in exc.recipients)
+    if isinstance(exc, aiosmtplib.SMTPResponseException):
+        return _is_transient_code(exc.code)
+    return isinstance(exc, OSError)
+
+
+def _is_transient_code(code: int) -> bool:
+    return 400 <= code < 500  # noqa: PLR2004
@@ -1,67 +1,244 @@
-from datetime import UTC, datetime
-from typing import override
+import asyncio
+from collections import defaultdict
+from collections.abc import AsyncIterator, Awaitable, Callable
+from contextlib import asynccontextmanager
+from enum import Enum
+from typing import TypeVar, override
 
-import jinja2
 from loguru import logger
-from sqlalchemy import select
 
 from src import metrics
-from src.config import settings
-from src.database import db_sessionmaker
-from src.database.models import DBUser
+from src.config import NotificationChannel, settings
 from src.notification.mailsender import Email, MailSender, MailSenderError
+from src.notification.outbox import NotificationOutbox, OutboxBatch, OutboxResults
 from src.notification.portalsender import PortalNotification, PortalNotificationError, PortalSender
+from src.notification.rendering import NotificationRenderer, RenderedNotification
+from src.notification.resilience import (
+    AdaptiveLimiter,
+    CircuitBreaker,
+    CircuitOpenError,
+    RetryPolicy,
+)
+from src.run_context import RunContext
+
+T = TypeVar("T")
+
+ResultCallback = Callable[[RenderedNotification, "SendResult"], None]
+
+
+class SendResult(Enum):
+    SENT = "sent"
+    # Временная ошибка (или разомкнут предохранитель), отправку можно повторить позже
+    DEFERRED = "deferred"
+    FAILED = "failed"
 
 
 class Notificator:
     """
     Отправляет уведомления об истечении пароля всем пользователям,
-    удовлетворяющим условиям
+    удовлетворяющим условиям. Уведомления ставятся в очередь в БД (outbox),
+    которую по каждому каналу параллельно разбирают воркеры. Число одновременных
+    отправок ограничено глобально и по каждому каналу
     """
 
     def __init__(self) -> None:
+        semaphore = asyncio.Semaphore(settings.notification.max_concurrency)
         self._notificators: list[AbstractNotificator] = [
-            MailNotificator(),
-            PortalNotificator(),
+            MailNotificator(semaphore),
+            PortalNotificator(semaphore),
         ]
         self._notify_at_days_to_expiry = settings.notify_at_days_to_expiry
+        self._renderer = NotificationRenderer()
+        self._outbox = NotificationOutbox([notificator.name for notificator in self._notificators])
+        self._outbox_workers = settings.notification.outbox_workers
+        # Рассылка и повторная отправка не должны идти одновременно: они делят подключения
+        self._run_lock = asyncio.Lock()
 
-    async def send_all(self) -> None:
-        logger.info("Preparing user notifications")
+    async def send_all(
+        self, run: RunContext, candidates: "asyncio.Queue[list[int] | None] | None" = None
+    ) -> None:
+        """
+        run - момент запуска, от которого считаются сроки истечения паролей.
+        candidates - очередь конвейерного режима (см. src.pipeline) с пачками id пользователей,
+        только что обновленных из AD. Уведомления им отправляются, не дожидаясь конца
+        синхронизации, None в очереди означает ее окончание
+        """
+        async with self._run_lock:
+            logger.info("Preparing user notifications")
 
-        async with db_sessionmaker() as session:
-            result = await session.scalars(select(DBUser))
-            users = list(result)
+            # Отправки прерванного запуска, которые не успели попасть в last_notification
+            await self._outbox.update_last_notification()
+            await self._outbox.purge_stale(run.today)
 
-        users_to_notify = [user for user in users if self._should_notify(user)]
-        logger.info(f"Going to notify {len(users_to_notify)} users")
+            async with self._dispatching():
+                if candidates is not None:
+                    while (user_ids := await candidates.get()) is not None:
+                        if await self._outbox.enqueue(
+                            self._notify_at_days_to_expiry, run.today, user_ids
+                        ):
+                            await self._drain_outbox(run)
 
-        for user in users_to_notify:
-            await self._notify_user(user)
+                enqueued = await self._outbox.enqueue(self._notify_at_days_to_expiry, run.today)
+                logger.info(f"Enqueued {enqueued} new notifications")
+                await self._drain_outbox(run)
 
-        logger.info("Updating 'last_notification' in DB")
-        async with db_sessionmaker.begin() as session:
-            session.add_all(users_to_notify)
+            logger.info("Updating 'last_notification' in DB")
+            await self._outbox.update_last_notification()
 
-    def _should_notify(self, user: DBUser) -> bool:
-        return (
-            user.ad_pwd_expires_in_days is not None
-            and user.ad_pwd_expires_in_days in self._notify_at_days_to_expiry
-        )
+    async def resend_deferred(self) -> None:
+        """
+        Повторяет отправки, отложенные из-за временных ошибок.
+        Отложенные в прошлые дни не отправляются: их порог уже не актуален
+        """
+        run = RunContext()
+        async with self._run_lock:
+            logger.info("Resending deferred notifications")
+            await self._outbox.purge_stale(run.today)
+            async with self._dispatching():
+                await self._drain_outbox(run)
+
+            logger.info("Updating 'last_notification' in DB")
+            await self._outbox.update_last_notification()
+
+    @asynccontextmanager
+    async def _dispatching(self) -> AsyncIterator[None]:
+        """
+        Одна рассылка: предохранители сбрасываются в начале, подключения закрываются в конце
+        """
+        for notificator in self._notificators:
+            notificator.reset_breaker()
+
+        try:
+            yield
+        finally:
+            for notificator in self._notificators:
+                await notificator.close()
+
+    async def _drain_outbox(self, run: RunContext) -> None:
+        async with asyncio.TaskGroup() as tg:
+            for notificator in self._notificators:
+                for _ in range(self._outbox_workers):
+                    tg.create_task(self._outbox_worker(notificator, run))
 
-    async def _notify_user(self, user: DBUser) -> None:
-        results = [await notificator.send(user) for notificator in self._notificators]
-        if any(results):
-            user.last_notification = datetime.now(UTC)
+    async def _outbox_worker(self, notificator: "AbstractNotificator", run: RunContext) -> None:
+        while (batch := await self._outbox.claim(notificator.name)).rows:
+            await self._send_batch(notificator, batch, run)
+
+    async def _send_batch(
+        self, notificator: "AbstractNotificator", batch: OutboxBatch, run: RunContext
+    ) -> None:
+        """
+        Отправляет забранную из очереди пачку, результаты записываются параллельно с отправкой
+        """
+        notifications = self._renderer.render_all(list(batch.users.values()), run)
+        row_ids: dict[int, list[int]] = defaultdict(list)
+        for row in batch.rows:
+            row_ids[row.user_id].append(row.id)
+
+        completed: asyncio.Queue[tuple[list[int], SendResult] | None] = asyncio.Queue()
+
+        def _on_result(notification: RenderedNotification, result: SendResult) -> None:
+            completed.put_nowait((row_ids.pop(notification.user.id), result))
+
+        writer = asyncio.create_task(self._save_completed(completed))
+        try:
+            await notificator.send_many(notifications, _on_result)
+            # Пользователь удален или его уведомление не удалось отрендерить
+            unsent = [row_id for ids in row_ids.values() for row_id in ids]
+            completed.put_nowait((unsent, SendResult.FAILED))
+        finally:
+            completed.put_nowait(None)
+            await writer
+
+    async def _save_completed(
+        self, completed: "asyncio.Queue[tuple[list[int], SendResult] | None]"
+    ) -> None:
+        """
+        Записывает результаты отправок по мере их завершения. Все, что накопилось
+        за время предыдущей записи, сохраняется одной короткой транзакцией
+        """
+        finished = False
+        while not finished:
+            results = OutboxResults()
+            item = await completed.get()
+            while item is not None:
+                ids, result = item
+                match result:
+                    case SendResult.SENT:
+                        results.sent.extend(ids)
+                    case SendResult.DEFERRED:
+                        results.deferred.extend(ids)
+                    case SendResult.FAILED:
+                        results.failed.extend(ids)
+                if completed.empty():
+                    break
+                item = completed.get_nowait()
+            finished = item is None
+
+            if results:
+                await self._outbox.save_results(results)
 
 
 class AbstractNotificator:
-    async def send(self, user: DBUser) -> bool: ...
+    name: NotificationChannel
 
+    def __init__(self, semaphore: asyncio.Semaphore) -> None:
+        # Общее ограничение на все каналы и отдельное на этот канал
+        self._global_semaphore = semaphore
+        self._limiter = AdaptiveLimiter(self.name, settings.notification.channel_limits[self.name])
+        self._breaker = CircuitBreaker(self.name)
+        self._retry = RetryPolicy()
 
-_jinja_env = jinja2.Environment(
-    undefined=jinja2.StrictUndefined, trim_blocks=True, lstrip_blocks=True
-)
+    async def send(self, notification: RenderedNotification) -> SendResult: ...
+
+    async def send_many(
+        self, notifications: list[RenderedNotification], on_result: ResultCallback | None = None
+    ) -> list[SendResult]:
+        """
+        Результат отправки для каждого пользователя, по умолчанию - по запросу на пользователя.
+        on_result вызывается для каждого уведомления сразу после завершения его отправки
+        """
+
+        async def _send(notification: RenderedNotification) -> SendResult:
+            result = await self._send_safe(notification)
+            if on_result:
+                on_result(notification, result)
+            return result
+
+        return list(await asyncio.gather(*(_send(notif) for notif in notifications)))
+
+    async def close(self) -> None:
+        """
+        Освобождает ресурсы канала (подключения) после рассылки
+        """
+
+    def reset_breaker(self) -> None:
+        self._breaker.reset()
+
+    async def _call(
+        self, func: Callable[[], Awaitable[T]], is_retriable: Callable[[Exception], bool]
+    ) -> T:
+        """
+        Выполняет запрос под адаптивным ограничением канала с повторами временных ошибок.
+        Временные ошибки считаются признаком перегрузки, между повторами слот не занимается
+        """
+
+        async def _limited() -> T:
+            async with self._limiter.acquire(is_retriable), self._global_semaphore:
+                return await func()
+
+        return await self._retry.call(_limited, self._breaker, is_retriable)
+
+    async def _send_safe(self, notification: RenderedNotification) -> SendResult:
+        try:
+            return await self.send(notification)
+        except Exception as e:
+            # Не прерываем остальные отправки, иначе не сохранится last_notification
+            metrics.errors.inc()
+            logger.opt(exception=e).error(
+                f"Notifying {notification.user.ad_login} via {self.name} failed"
+            )
+            return SendResult.FAILED
 
 
 class MailNotificator(AbstractNotificator):
@@ -69,33 +246,42 @@ class MailNotificator(AbstractNotificator):
     Отправляет уведомление на почту пользователя, указанную во внешней БД
     """
 
-    def __init__(self) -> None:
+    name = "email"
+
+    def __init__(self, semaphore: asyncio.Semaphore) -> None:
+        super().__init__(semaphore)
         self._mailsender = MailSender()
 
-        self._subject_template = _jinja_env.from_string(settings.email_subject)
-        self._content_plain_template = _jinja_env.from_string(settings.email_content_plain)
-        self._content_html_template = _jinja_env.from_string(settings.email_content_html)
+    @override
+    async def close(self) -> None:
+        await self._mailsender.close()
 
     @override
-    async def send(self, user: DBUser) -> bool:
+    async def send(self, notification: RenderedNotification) -> SendResult:
+        user = notification.user
         if not user.externaldb_email:
-            return False
+            return SendResult.FAILED
 
         email = Email(
             recipient=user.externaldb_email,
-            subject=self._subject_template.render(user=user),
-            content_plain=self._content_plain_template.render(user=user),
-            content_html=self._content_html_template.render(user=user),
+            subject=notification.email_subject,
+            content_plain=notification.email_content_plain,
+            content_html=notification.email_content_html,
         )
         try:
-            await self._mailsender.send(email)
+            await self._call(
+                lambda: self._mailsender.send(email),
+                lambda e: isinstance(e, MailSenderError) and e.retriable,
+            )
+        except CircuitOpenError:
+            return SendResult.DEFERRED
         except MailSenderError as e:
             metrics.errors.inc()
             logger.error(f"Mail notification to {user.ad_login} failed: {e}")
-            return False
+            return SendResult.DEFERRED if e.retriable else SendResult.FAILED
 
-        metrics.notifications_sent.labels("email").inc()
-        return True
+        metrics.notifications_sent.labels(self.name).inc()
+        return SendResult.SENT
 
 
 class PortalNotificator(AbstractNotificator):
@@ -103,27 +289,76 @@ class PortalNotificator(AbstractNotificator):
     Отправляет уведомления на порталы, включенные в конфигурации
     """
 
-    def __init__(self) -> None:
+    name = "portals"
+
+    def __init__(self, semaphore: asyncio.Semaphore) -> None:
+        super().__init__(semaphore)
         self._portalsender = PortalSender()
 
-        self._title_template = _jinja_env.from_string(settings.portal_title)
-        self._summary_template = _jinja_env.from_string(settings.portal_summary)
-        self._content_template = _jinja_env.from_string(settings.email_content_html)
+    @override
+    async def send(self, notification: RenderedNotification) -> SendResult:
+        return (await self.send_many([notification]))[0]
 
     @override
-    async def send(self, user: DBUser) -> bool:
-        notif = PortalNotification(
-            user_id=user.externaldb_id,
-            title=self._title_template.render(user=user),
-            summary=self._summary_template.render(user=user),
-            content=self._content_template.render(user=user),
+    async def send_many(
+        self, notifications: list[RenderedNotification], on_result: ResultCallback | None = None
+    ) -> list[SendResult]:
+        """
+        Пользователи с одинаковым текстом уведомления отправляются одним запросом
+        """
+        by_user_id = {notif.user.externaldb_id: notif for notif in notifications}
+
+        async def _send(batch: list[PortalNotification]) -> dict[str, SendResult]:
+            batch_results = await self._send_batch(batch)
+            if on_result:
+                for user_id, result in batch_results.items():
+                    on_result(by_user_id[user_id], result)
+            return batch_results
+
+        batches = self._portalsender.make_batches(
+            [
+                PortalNotification(
+                    user_id=notif.user.externaldb_id,
+                    title=notif.portal_title,
+                    summary=notif.portal_summary,
+                    content=notif.portal_content,
+                )
+                for notif in notifications
+            ]
         )
+        results: dict[str, SendResult] = {}
+        for batch_results in await asyncio.gather(*(_send(batch) for batch in batches)):
+            results.update(batch_results)
+
+        sent = sum(result == SendResult.SENT for result in results.values())
+        metrics.notifications_sent.labels(self.name).inc(sent)
+        return [results[notif.user.externaldb_id] for notif in notifications]
+
+    async def _send_batch(self, batch: list[PortalNotification]) -> dict[str, SendResult]:
         try:
-            await self._portalsender.send(notif)
+            await self._call(
+                lambda: self._portalsender.send_batch(batch),
+                lambda e: isinstance(e, PortalNotificationError) and e.retriable,
+            )
+        except CircuitOpenError:
+            return dict.fromkeys((notif.user_id for notif in batch), SendResult.DEFERRED)
         except PortalNotificationError as e:
+            if e.rejected and len(batch) > 1:
+                # Сервис отклонил пачку - отправляем по одному, чтобы найти проблемных пользователей
+                logger.warning(f"{e}, retrying one by one")
+                results: dict[str, SendResult] = {}
+                for notif_results in await asyncio.gather(
+                    *(self._send_batch([notif]) for notif in batch)
+                ):
+                    results.update(notif_results)
+                return results
+            metrics.errors.inc()
+            logger.error(f"Portal notification failed: {e}")
+            result = SendResult.DEFERRED if e.retriable else SendResult.FAILED
+            return dict.fromkeys((notif.user_id for notif in batch), result)
+        except Exception as e:
             metrics.errors.inc()
-            logger.error(f"Portal notification to {user.ad_login} failed: {e}")
-            return False
+            logger.opt(exception=e).error(f"Portal notification to {len(batch)} users failed")
+            return dict.fromkeys((notif.user_id for notif in batch), SendResult.FAILED)
 
-        metrics.notifications_sent.labels("portals").inc()
-        return True
+        return dict.fromkeys((notif.user_id for notif in batch), SendResult.SENT)
@@ -0,0 +1,204 @@
+from dataclasses import dataclass, field
+from datetime import UTC, date, datetime, timedelta
+
+from loguru import logger
+from sqlalchemy import (
+    ARRAY,
+    Integer,
+    String,
+    any_,
+    bindparam,
+    case,
+    cast,
+    column,
+    delete,
+    func,
+    or_,
+    select,
+    true,
+    update,
+    values,
+)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from src.config import settings
+from src.database import db_sessionmaker
+from src.database.models import DBNotificationOutbox, DBUser
+from src.database.rows import OutboxRow, UserToNotify
+
+
+@dataclass(slots=True)
+class OutboxBatch:
+    """
+    Пачка уведомлений, забранная воркером, и пользователи для них
+    """
+
+    rows: list[OutboxRow]
+    users: dict[int, UserToNotify] = field(default_factory=dict)
+
+
+@dataclass(slots=True)
+class OutboxResults:
+    """
+    id строк очереди, разложенные по результатам отправки
+    """
+
+    sent: list[int] = field(default_factory=list)
+    deferred: list[int] = field(default_factory=list)
+    failed: list[int] = field(default_factory=list)
+
+    def __bool__(self) -> bool:
+        return bool(self.sent or self.deferred or self.failed)
+
+
+class NotificationOutbox:
+    """
+    Очередь уведомлений в БД. Запуск ставит в нее все уведомления дня одним запросом,
+    воркеры забирают из нее пачки в аренду и отмечают строки по мере отправки,
+    поэтому после падения повторно отправляются только те уведомления, отправка
+    которых была прервана, и не раньше, чем истечет аренда
+    """
+
+    def __init__(self, channels: list[str]) -> None:
+        self._channels = channels
+        self._batch_size = settings.notification.outbox_batch_size
+        self._max_attempts = settings.notification.outbox_max_attempts
+        self._retry_after = timedelta(minutes=settings.notification.outbox_retry_after_minutes)
+        self._lease = timedelta(minutes=settings.notification.outbox_lease_minutes)
+
+    async def enqueue(
+        self, days_to_expiry: list[int], today: date, user_ids: list[int] | None = None
+    ) -> int:
+        """
+        Ставит в очередь уведомления по всем каналам для пользователей на порогах days_to_expiry.
+        user_ids ограничивает выборку указанными пользователями (конвейерный режим)
+        """
+        channels = values(column("channel", String), name="channels").data(
+            [(channel,) for channel in self._channels]
+        )
+        users = (
+            select(
+                DBUser.id,
+                channels.c.channel,
+                DBUser.ad_pwd_expiry_date,
+                cast(DBUser.ad_pwd_expiry_date - today, Integer),
+            )
+            .join(channels, true())
+            .where(
+                DBUser.expires_in_days(days_to_expiry, today),
+                # Без адреса письмо отправить некуда
+                or_(channels.c.channel != "email", DBUser.externaldb_email != ""),
+            )
+        )
+        if user_ids is not None:
+            users = users.where(DBUser.id == any_(bindparam("user_ids", user_ids, ARRAY(Integer))))
+        stmt = (
+            pg_insert(DBNotificationOutbox)
+            .from_select(["user_id", "channel", "expiry_date", "days_to_expiry"], users)
+            .on_conflict_do_nothing(
+                index_elements=["user_id", "channel", "expiry_date", "days_to_expiry"]
+            )
+        )
+        async with db_sessionmaker.begin() as session:
+            result = await session.execute(stmt)
+        return result.rowcount  # type: ignore
+
+    async def purge_stale(self, today: date) -> None:
+        """
+        Удаляет уведомления прошлых дней: их порог уже не актуален
+        """
+        stmt = delete(DBNotificationOutbox).where(
+            DBNotificationOutbox.expiry_date - DBNotificationOutbox.days_to_expiry < today
+        )
+        async with db_sessionmaker.begin() as session:
+            result = await session.execute(stmt)
+        logger.info(f"Purged {result.rowcount} stale outbox rows")  # type: ignore
+
+    async def claim(self, channel: str) -> OutboxBatch:
+        """
+        Забирает в аренду пачку неотправленных уведомлений канала и пользователей для них.
+        Аренда (available_at через outbox_lease_minutes) фиксируется сразу, поэтому
+        транзакция и подключение не удерживаются на время отправки
+        """
+        pending = (
+            select(DBNotificationOutbox.id)
+            .where(
+                DBNotificationOutbox.status == "pending",
+                DBNotificationOutbox.channel == channel,
+                DBNotificationOutbox.available_at <= func.now(),
+            )
+            .order_by(DBNotificationOutbox.id)
+            .limit(self._batch_size)
+            .with_for_update(skip_locked=True)
+        )
+        stmt = (
+            update(DBNotificationOutbox)
+            .where(DBNotificationOutbox.id.in_(pending))
+            .values(available_at=func.now() + self._lease)
+            .returning(*OutboxRow.select().selected_columns)
+        )
+        async with db_sessionmaker.begin() as session:
+            result = await session.execute(stmt)
+            batch = OutboxBatch([OutboxRow(*row) for row in result])
+
+            if batch.rows:
+                user_ids = list({row.user_id for row in batch.rows})
+                user_result = await session.execute(
+                    UserToNotify.select().where(
+                        DBUser.id == any_(bindparam("user_ids", user_ids, ARRAY(Integer)))
+                    )
+                )
+                batch.users = {row.id: UserToNotify(*row) for row in user_result}
+
+        return batch
+
+    async def save_results(self, results: OutboxResults) -> None:
+        """
+        Записывает результаты отправки тремя UPDATE ... WHERE id = ANY(...) в отдельной транзакции
+        """
+        now = datetime.now(UTC)
+        outbox = DBNotificationOutbox
+        attempts = outbox.attempts + 1
+        updates = [
+            (results.sent, {"status": "sent", "attempts": attempts, "sent_at": now}),
+            (results.failed, {"status": "failed", "attempts": attempts}),
+            # Отложенное уведомление повторяется через outbox_retry_after_minutes,
+            # пока не кончатся попытки
+            (
+                results.deferred,
+                {
+                    "status": case((attempts >= self._max_attempts, "failed"), else_=outbox.status),
+                    "attempts": attempts,
+                    "available_at": now + self._retry_after,
+                },
+            ),
+        ]
+        async with db_sessionmaker.begin() as session:
+            for ids, new_values in updates:
+                if ids:
+                    await session.execute(
+                        update(outbox)
+                        .where(outbox.id == any_(bindparam("ids", ids, ARRAY(Integer))))
+                        .values(new_values)
+                    )
+
+    async def update_last_notification(self) -> None:
+        """
+        Переносит время последней успешной отправки из очереди в user.last_notification
+        """
+        sent = (
+            select(
+                DBNotificationOutbox.user_id,
+                func.max(DBNotificationOutbox.sent_at).label("sent_at"),
+            )
+            .where(DBNotificationOutbox.status == "sent")
+            .group_by(DBNotificationOutbox.user_id)
+            .subquery()
+        )
+        stmt = (
+            update(DBUser)
+            .where(DBUser.id == sent.c.user_id, sent.c.sent_at > DBUser.last_notification)
+            .values(last_notification=sent.c.sent_at)
+        )
+        async with db_sessionmaker.begin() as session:
+            await session.execute(stmt)
@@ -1,4 +1,5 @@
 from dataclasses import dataclass
+from http import HTTPStatus
 from typing import Any
 
 from loguru import logger
@@ -17,10 +18,26 @@ class PortalNotification:
 
 
 class PortalNotificationError(Exception):
-    def __init__(self, notification: PortalNotification, error: str) -> None:
-        msg = f"Error notifying user {notification.user_id} via portals: {error}"
+    def __init__(
+        self,
+        notifications: list[PortalNotification],
+        error: str,
+        *,
+        rejected: bool = False,
+        retriable: bool = False,
+    ) -> None:
+        users = (
+            f"user {notifications[0].user_id}"
+            if len(notifications) == 1
+            else f"{len(notifications)} users"
+        )
+        msg = f"Error notifying {users} via portals: {error}"
         super().__init__(msg)
-        self.notification = notification
+        self.notifications = notifications
+        # Сервис ответил отказом (в отличие от сетевой ошибки)
+        self.rejected = rejected
+        # Временная ошибка (сеть, 5xx, 429), запрос можно повторить
+        self.retriable = retriable
 
 
 class PortalSender:
@@ -36,22 +53,54 @@ class PortalSender:
             for app_name, app_id in settings.portal_application_ids.items()
             if app_name in settings.enabled_portal_applications
         ]
+        self._batch_size = settings.notification.portal_batch_size
+
+    def make_batches(
+        self, notifications: list[PortalNotification]
+    ) -> list[list[PortalNotification]]:
+        """
+        Группирует уведомления с одинаковым содержимым в пачки не больше portal_batch_size,
+        каждая пачка отправляется одним запросом
+        """
+        groups: dict[tuple[str, str, str, bool], list[PortalNotification]] = {}
+        for notification in notifications:
+            key = (
+                notification.title,
+                notification.summary,
+                notification.content,
+                notification.prevent_disappearance,
+            )
+            groups.setdefault(key, []).append(notification)
+
+        return [
+            group[i : i + self._batch_size]
+            for group in groups.values()
+            for i in range(0, len(group), self._batch_size)
+        ]
 
     async def send(self, notification: PortalNotification) -> None:
-        logger.debug(f"Sending portal notification to {notification.user_id}")
+        await self.send_batch([notification])
+
+    async def send_batch(self, notifications: list[PortalNotification]) -> None:
+        """
+        Отправляет одним запросом уведомления с одинаковым содержимым (см. make_batches)
+        """
+        user_ids = [notification.user_id for notification in notifications]
+        recipients = user_ids[0] if len(user_ids) == 1 else f"{len(user_ids)} users"
+        logger.debug(f"Sending portal notification to {recipients}")
 
         if settings.debug.portal_notification_disabled:
             logger.warning(
-                "Portal notifications are disabled - "
-                f"message to '{notification.user_id}' will not be sent"
+                f"Portal notifications are disabled - message to '{recipients}' will not be sent"
             )
             return
 
+        notification = notifications[0]
         request_body = {
             "title": notification.title,
             "summary": notification.summary,
             "content": notification.content,
-            "users": [notification.user_id],
+            "users": user_ids,
             "preventDisappearance": notification.prevent_disappearance,
             "apps": self._sendto_application_ids,
         }
@@ -67,12 +116,18 @@ class PortalSender:
                 headers=headers,
             ) as response:
                 is_ok = response.ok
+                status = response.status
                 response_body: dict[str, Any] = await response.json()
         except Exception as e:
-            raise PortalNotificationError(notification, repr(e)) from e
+            raise PortalNotificationError(notifications, repr(e), retriable=True) from e
 
         if not is_ok or not response_body.get("success", False):
             error = f"Negative response recieved:\n{response_body}"
-            raise PortalNotificationError(notification, error)
+            retriable = not is_ok and (
+                status >= HTTPStatus.INTERNAL_SERVER_ERROR or status == HTTPStatus.TOO_MANY_REQUESTS
+            )
+            raise PortalNotificationError(
+                notifications, error, rejected=not retriable, retriable=retriable
+            )
 
-        logger.debug(f"Succesfully sent portal notif to user {notification.user_id}")
+        logger.debug(f"Succesfully sent portal notif to {recipients}")
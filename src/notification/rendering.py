@@ -0,0 +1,172 @@
+from collections.abc import Sequence
+from dataclasses import dataclass
+from datetime import datetime
+from functools import lru_cache
+from time import perf_counter
+from types import SimpleNamespace
+from typing import Self
+
+import jinja2
+from jinja2 import nodes
+from loguru import logger
+
+from src import metrics
+from src.config import settings
+from src.database.models import DBUser
+from src.database.rows import UserToNotify
+from src.run_context import RunContext
+
+_jinja_env = jinja2.Environment(
+    undefined=jinja2.StrictUndefined, trim_blocks=True, lstrip_blocks=True
+)
+
+# Полная ORM-модель нужна только при прямой отправке, рассылка из очереди работает с проекциями
+NotifiedUser = DBUser | UserToNotify
+
+# Поля, от которых зависит текст, общий для всех пользователей с одним сроком истечения
+_DAYS_FIELDS = frozenset({"ad_pwd_expires_in_days"})
+
+
+@dataclass(frozen=True, slots=True)
+class RenderContext:
+    """
+    Данные пользователя, доступные в шаблонах как user.*.
+    Собираются один раз на пользователя, чтобы не пересчитывать свойства в каждом шаблоне
+    """
+
+    externaldb_id: str
+    externaldb_fio: str
+    externaldb_group: str
+    externaldb_email: str
+    ad_login: str
+    ad_pwd_expiry: datetime | None
+    ad_pwd_expires_in_days: int | None
+
+    @classmethod
+    def from_user(cls, user: NotifiedUser, days_to_expiry: int | None) -> Self:
+        return cls(
+            externaldb_id=user.externaldb_id,
+            externaldb_fio=user.externaldb_fio,
+            externaldb_group=user.externaldb_group,
+            externaldb_email=user.externaldb_email,
+            ad_login=user.ad_login,
+            ad_pwd_expiry=user.ad_pwd_expiry,
+            ad_pwd_expires_in_days=days_to_expiry,
+        )
+
+
+@dataclass(frozen=True, slots=True)
+class RenderedNotification:
+    user: NotifiedUser
+    email_subject: str
+    email_content_plain: str
+    email_content_html: str
+    portal_title: str
+    portal_summary: str
+    portal_content: str
+
+
+class _CompiledTemplate:
+    """
+    Шаблон, который зависит только от числа дней до истечения, рендерится
+    один раз на каждое значение и берется из LRU-кэша
+    """
+
+    def __init__(self, source: str) -> None:
+        self._template = _jinja_env.from_string(source)
+        self.days_only = _get_user_fields(source) <= _DAYS_FIELDS
+        self._render_for_days = lru_cache(maxsize=64)(self._render_days)
+
+    def render(self, context: RenderContext) -> str:
+        if self.days_only:
+            return self._render_for_days(context.ad_pwd_expires_in_days)
+        return self._template.render(user=context)
+
+    def _render_days(self, days: int | None) -> str:
+        return self._template.render(user=SimpleNamespace(ad_pwd_expires_in_days=days))
+
+
+def _get_user_fields(source: str) -> set[str]:
+    """
+    Поля user.*, которые использует шаблон. Если user используется как-то иначе
+    (user['x'], передача в фильтр и т.п.), возвращается "*", чтобы шаблон не кэшировался
+    """
+    ast = _jinja_env.parse(source)
+    user_getattrs = [
+        node
+        for node in ast.find_all(nodes.Getattr)
+        if isinstance(node.node, nodes.Name) and node.node.name == "user"
+    ]
+    user_names = [node for node in ast.find_all(nodes.Name) if node.name == "user"]
+    if len(user_names) != len(user_getattrs):
+        return {"*"}
+    return {node.attr for node in user_getattrs}
+
+
+class NotificationRenderer:
+    """
+    Рендерит тексты уведомлений. Одинаковые шаблоны компилируются и рендерятся
+    для пользователя один раз
+    """
+
+    def __init__(self) -> None:
+        sources = {
+            "email_subject": settings.email_subject,
+            "email_content_plain": settings.email_content_plain,
+            "email_content_html": settings.email_content_html,
+            "portal_title": settings.portal_title,
+            "portal_summary": settings.portal_summary,
+            "portal_content": settings.portal_content,
+        }
+        compiled: dict[str, _CompiledTemplate] = {}
+        for source in sources.values():
+            if source not in compiled:
+                compiled[source] = _CompiledTemplate(source)
+        self._templates = {name: compiled[source] for name, source in sources.items()}
+        self._distinct_templates = list(compiled.values())
+
+        for name in ("portal_title", "portal_summary", "portal_content"):
+            if not self._templates[name].days_only:
+                logger.warning(
+                    f"Template {name} depends on user fields other than the days to expiry, "
+                    "portal notifications will not be batched"
+                )
+
+    def render(self, user: NotifiedUser, run: RunContext) -> RenderedNotification:
+        days_to_expiry = run.days_to_expiry(
+            user.ad_pwd_expiry, disabled=user.ad_disabled, expired=user.ad_pwd_expired
+        )
+        return self._render(user, days_to_expiry)
+
+    def _render(self, user: NotifiedUser, days_to_expiry: int | None) -> RenderedNotification:
+        context = RenderContext.from_user(user, days_to_expiry)
+        rendered = {template: template.render(context) for template in self._distinct_templates}
+        texts = {name: rendered[template] for name, template in self._templates.items()}
+        return RenderedNotification(user=user, **texts)
+
+    def render_all(
+        self, users: Sequence[NotifiedUser], run: RunContext
+    ) -> list[RenderedNotification]:
+        """
+        Дни до истечения считаются для всей пачки за один проход.
+        Пользователи, для которых рендеринг не удался, пропускаются
+        """
+        start = perf_counter()
+        notifications: list[RenderedNotification] = []
+        for user, days_to_expiry in zip(users, run.days_to_expiry_many(users), strict=True):
+            try:
+                notifications.append(self._render(user, days_to_expiry))
+            except jinja2.TemplateError as e:
+                metrics.errors.inc()
+                logger.opt(exception=e).error(f"Rendering notification for {user.ad_login} failed")
+
+        elapsed = perf_counter() - start
+        renders = len(notifications) * len(self._distinct_templates)
+        renders_per_second = renders / elapsed if elapsed else 0
+        metrics.notification_renders.inc(renders)
+        metrics.notification_renders_per_second.set(renders_per_second)
+        logger.info(
+            f"Rendered {len(notifications)} notifications in {elapsed:.3f}s "
+            f"({renders_per_second:.0f} renders/s)"
+        )
+        return notifications
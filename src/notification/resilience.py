@@ -0,0 +1,168 @@
+import asyncio
+import random
+from collections.abc import AsyncIterator, Awaitable, Callable
+from contextlib import asynccontextmanager
+from time import monotonic
+from typing import TypeVar
+
+from loguru import logger
+
+from src import metrics
+from src.config import ChannelLimitSettings, settings
+
+T = TypeVar("T")
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, channel: str) -> None:
+        super().__init__(f"Circuit breaker for {channel} is open")
+        self.channel = channel
+
+
+class CircuitBreaker:
+    """
+    Размыкается после breaker_failure_threshold временных ошибок подряд и до конца
+    запуска сразу отклоняет отправки по каналу, не дожидаясь таймаутов
+    """
+
+    def __init__(self, channel: str) -> None:
+        self._channel = channel
+        self._failure_threshold = settings.notification.breaker_failure_threshold
+        self.reset()
+
+    @property
+    def is_open(self) -> bool:
+        return self._is_open
+
+    def reset(self) -> None:
+        self._failures = 0
+        self._is_open = False
+        metrics.notification_circuit_open.labels(self._channel).set(0)
+
+    def check(self) -> None:
+        if self._is_open:
+            raise CircuitOpenError(self._channel)
+
+    def record_success(self) -> None:
+        self._failures = 0
+
+    def record_failure(self) -> None:
+        self._failures += 1
+        if not self._is_open and self._failures >= self._failure_threshold:
+            logger.error(f"Too many failures, opening circuit breaker for {self._channel}")
+            self._is_open = True
+            metrics.notification_circuit_open.labels(self._channel).set(1)
+
+
+class RetryPolicy:
+    """
+    Повторяет временные ошибки с экспоненциальной задержкой и случайным разбросом (full jitter)
+    """
+
+    def __init__(self) -> None:
+        self._attempts = settings.notification.retry_attempts
+        self._base_delay = settings.notification.retry_base_delay_seconds
+        self._max_delay = settings.notification.retry_max_delay_seconds
+
+    async def call(
+        self,
+        func: Callable[[], Awaitable[T]],
+        breaker: CircuitBreaker,
+        is_retriable: Callable[[Exception], bool],
+    ) -> T:
+        """
+        Временные ошибки учитываются предохранителем, постоянные (например, отказ
+        по конкретному получателю) пробрасываются сразу
+        """
+        attempt = 0
+        while True:
+            breaker.check()
+            try:
+                result = await func()
+            except Exception as e:
+                if not is_retriable(e):
+                    raise
+                breaker.record_failure()
+                attempt += 1
+                if attempt >= self._attempts or breaker.is_open:
+                    raise
+                delay = self.get_delay(attempt)
+                logger.warning(f"Retrying in {delay:.1f}s after error: {e}")
+                await asyncio.sleep(delay)
+            else:
+                breaker.record_success()
+                return result
+
+    def get_delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self._max_delay, self._base_delay * 2 ** (attempt - 1)))
+
+
+class AdaptiveLimiter:
+    """
+    Ограничивает число одновременных запросов к каналу по схеме AIMD: лимит растет
+    на 1 за каждые limit быстрых успешных ответов и уменьшается вдвое при признаках
+    перегрузки удаленной стороны. max_rps дополнительно ограничивает частоту запросов
+    """
+
+    def __init__(self, channel: str, limits: ChannelLimitSettings) -> None:
+        self._channel = channel
+        self._max_limit = limits.max_concurrency
+        self._limit = float(min(limits.initial_concurrency, self._max_limit))
+        self._target_latency = limits.target_latency_seconds
+        self._min_interval = 1 / limits.max_rps if limits.max_rps else 0.0
+
+        self._in_flight = 0
+        self._condition = asyncio.Condition()
+        self._next_start = 0.0
+        self._last_decrease = 0.0
+        metrics.notification_channel_limit.labels(channel).set(self._limit)
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    @asynccontextmanager
+    async def acquire(self, is_overload: Callable[[Exception], bool]) -> AsyncIterator[None]:
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._in_flight < self.limit)
+            self._in_flight += 1
+
+        try:
+            await self._wait_for_rate()
+            start = monotonic()
+            try:
+                yield
+            except Exception as e:
+                if is_overload(e):
+                    self._decrease(start)
+                raise
+            if monotonic() - start <= self._target_latency:
+                self._increase()
+        finally:
+            async with self._condition:
+                self._in_flight -= 1
+                self._condition.notify_all()
+
+    async def _wait_for_rate(self) -> None:
+        if not self._min_interval:
+            return
+        now = monotonic()
+        start_at = max(now, self._next_start)
+        self._next_start = start_at + self._min_interval
+        if start_at > now:
+            await asyncio.sleep(start_at - now)
+
+    def _increase(self) -> None:
+        self._limit = min(self._max_limit, self._limit + 1 / self._limit)
+        metrics.notification_channel_limit.labels(self._channel).set(self._limit)
+
+    def _decrease(self, request_start: float) -> None:
+        # Запросы, начатые до предыдущего снижения, уже учтены в нем
+        if request_start < self._last_decrease:
+            return
+        self._last_decrease = monotonic()
+        self._limit = max(1.0, self._limit / 2)
+        logger.warning(
+            f"Remote side of {self._channel} is overloaded, limit lowered to {self.limit}"
+        )
+        metrics.notification_channel_limit.labels(self._channel).set(self._limit)
@@ -0,0 +1,69 @@
+import asyncio
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from time import perf_counter
+
+from loguru import logger
+
+from src import metrics
+from src.active_directory import ADSyncer
+from src.config import settings
+from src.externaldb import ExternalDBSyncer
+from src.notification.notificator import Notificator
+from src.run_context import RunContext
+
+
+@asynccontextmanager
+async def timed_stage(name: str) -> AsyncIterator[None]:
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = perf_counter() - start
+        metrics.stage_duration.labels(name).set(elapsed)
+        logger.info(f"Stage {name} took {elapsed:.1f}s")
+
+
+async def run_sequential(
+    externaldb_syncer: ExternalDBSyncer, ad_syncer: ADSyncer, notificator: Notificator
+) -> None:
+    run = RunContext()
+    async with timed_stage("total"):
+        async with timed_stage("externaldb"):
+            await externaldb_syncer.sync()
+        async with timed_stage("ad"):
+            await ad_syncer.sync(run)
+        async with timed_stage("notify"):
+            await notificator.send_all(run)
+
+
+async def run_pipelined(
+    externaldb_syncer: ExternalDBSyncer, ad_syncer: ADSyncer, notificator: Notificator
+) -> None:
+    """
+    Внешняя БД синхронизируется одной транзакцией и определяет состав пользователей,
+    поэтому идет первой. Обновление из AD и рассылка идут одновременно: сохраненные пачки
+    пользователей передаются в рассылку через ограниченную очередь, и если рассылка
+    не успевает, обновление из AD ждет освобождения места
+    """
+    run = RunContext()
+    async with timed_stage("total"):
+        async with timed_stage("externaldb"):
+            await externaldb_syncer.sync()
+
+        candidates: asyncio.Queue[list[int] | None] = asyncio.Queue(
+            maxsize=settings.pipeline.queue_size
+        )
+
+        async def _ad_stage() -> None:
+            async with timed_stage("ad"):
+                await ad_syncer.sync(run, candidates)
+            await candidates.put(None)
+
+        async def _notify_stage() -> None:
+            async with timed_stage("notify"):
+                await notificator.send_all(run, candidates)
+
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(_ad_stage())
+            tg.create_task(_notify_stage())
@@ -0,0 +1,58 @@
+from collections.abc import Iterable
+from datetime import date, datetime, time, timedelta
+from typing import Protocol
+
+from src.utils import MSK
+
+# Начало "дня истечения" 1970-01-01: пароль, истекающий до 09:00 по МСК включительно,
+# считается истекающим накануне (см. get_pwd_expiry_date)
+_EXPIRY_DAY_ANCHOR = datetime.combine(date(1970, 1, 1), time(9, 0, 0, 1), tzinfo=MSK)
+_EPOCH = date(1970, 1, 1)
+
+
+class PwdExpiryHolder(Protocol):
+    @property
+    def ad_pwd_expiry(self) -> datetime | None: ...
+    @property
+    def ad_disabled(self) -> bool: ...
+    @property
+    def ad_pwd_expired(self) -> bool: ...
+
+
+class RunContext:
+    """
+    Единый момент времени, на который выполняется запуск. Все этапы берут "сейчас"
+    и "сегодня" отсюда, поэтому запуск, перешедший через полночь, не получает
+    расхождений между этапами
+    """
+
+    __slots__ = ("_today_index", "now", "today")
+
+    def __init__(self, now: datetime | None = None) -> None:
+        self.now = (now or datetime.now(MSK)).astimezone(MSK)
+        self.today = self.now.date()
+        self._today_index = (self.today - _EPOCH).days
+
+    def days_to_expiry(
+        self, pwd_expiry: datetime | None, *, disabled: bool, expired: bool
+    ) -> int | None:
+        """
+        Дней до истечения пароля на сегодня. Одно вычитание datetime вместо
+        перевода в МСК и сравнения времени, как в get_pwd_expiry_date
+        """
+        if not pwd_expiry or disabled or expired:
+            return None
+        return (pwd_expiry - _EXPIRY_DAY_ANCHOR).days - self._today_index
+
+    def days_to_expiry_many(self, users: Iterable[PwdExpiryHolder]) -> list[int | None]:
+        anchor = _EXPIRY_DAY_ANCHOR
+        today_index = self._today_index
+        return [
+            None
+            if not user.ad_pwd_expiry or user.ad_disabled or user.ad_pwd_expired
+            else (user.ad_pwd_expiry - anchor).days - today_index
+            for user in users
+        ]
+
+    def start_of_day(self, days: int = 0) -> datetime:
+        return datetime.combine(self.today + timedelta(days=days), time(), tzinfo=MSK)
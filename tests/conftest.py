@@ -1,9 +1,15 @@
+import os
+from collections.abc import AsyncIterator
 from unittest.mock import AsyncMock, MagicMock
 
+import aiosmtplib
 import pytest
 from pytest_mock import MockerFixture
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
 
 from src.config import settings
+from src.database import db_engine_manager, db_sessionmaker
+from src.database.db_utils import purge_database
 from src.notification.mailsender import Email
 from src.notification.portalsender import PortalNotification
 
@@ -13,10 +19,31 @@ def _adjust_settings() -> None:
     settings.smtp_secrets.hostname = "http://localhost"
     settings.notification_api_base_url = "http://localhost"
 
+    settings.notification.retry_base_delay_seconds = 0
+
     settings.debug.email_disabled = False
     settings.debug.portal_notification_disabled = False
 
 
+# Тесты с БД запускаются, только если задана тестовая база Postgres, которую можно очищать
+TEST_DATABASE_URL = os.environ.get("TEST_DATABASE_URL")
+
+
+@pytest.fixture()
+async def db_engine(monkeypatch: pytest.MonkeyPatch) -> AsyncIterator[AsyncEngine]:
+    if not TEST_DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL is not set")
+
+    engine = create_async_engine(TEST_DATABASE_URL)
+    monkeypatch.setattr(db_engine_manager, "_engine", engine, raising=False)
+    db_sessionmaker.configure(bind=engine)
+    await purge_database()
+    yield engine
+    await purge_database()
+    db_sessionmaker.configure(bind=None)
+    await engine.dispose()
+
+
 @pytest.fixture()
 def sent_emails(monkeypatch: pytest.MonkeyPatch) -> list[Email]:
     _sent_emails: list[Email] = []
@@ -30,9 +57,19 @@ def sent_emails(monkeypatch: pytest.MonkeyPatch) -> list[Email]:
 
 @pytest.fixture(autouse=True)
 def mock_smtp_send(mocker: MockerFixture) -> AsyncMock:
-    smtp_mock = AsyncMock()
+    smtp_mock = mocker.create_autospec(aiosmtplib.SMTP, instance=True)
+    smtp_mock.is_connected = False
+
+    async def _connect() -> None:
+        smtp_mock.is_connected = True
+
+    async def _quit() -> None:
+        smtp_mock.is_connected = False
+
+    smtp_mock.connect.side_effect = _connect
+    smtp_mock.quit.side_effect = _quit
     mocker.patch("src.notification.mailsender.aiosmtplib.SMTP", return_value=smtp_mock)
-    return smtp_mock.__aenter__.return_value.send_message
+    return smtp_mock.sendmail
 
 
 @pytest.fixture()
@@ -0,0 +1,374 @@
+import asyncio
+from collections.abc import Iterable
+from datetime import UTC, datetime, time, timedelta
+from typing import Any
+from unittest.mock import MagicMock
+
+import pytest
+from ldap3 import NONE, SAFE_SYNC, SYNC, Connection, Server
+from pydantic import ValidationError
+from pytest_mock import MockerFixture
+
+from src.active_directory import (
+    ADClient,
+    ADClientPool,
+    ADConnectionError,
+    ADError,
+    ADServerRouter,
+    ADServerState,
+    ADSyncer,
+    ADUser,
+    RawEntriesStrategy,
+    decode_users_page,
+    filetime_to_datetime,
+    use_raw_entries,
+)
+from src.config import ADSecrets, settings
+from src.database.models import DBSyncState
+from src.database.rows import UserToRefresh
+from src.run_context import RunContext
+from src.utils import MSK
+
+SEARCH_OK = {"result": 0, "description": "success", "message": ""}
+
+
+def make_entry(login: str, uac: int = 0x200, uac_live: int = 0, expiry: int = 0) -> dict:
+    return {
+        "type": "searchResEntry",
+        "raw_attributes": {
+            "sAMAccountName": [login.encode()],
+            "userAccountControl": [str(uac).encode()],
+            "msDS-User-Account-Control-Computed": [str(uac_live).encode()],
+            "msDS-UserPasswordExpiryTimeComputed": [str(expiry).encode()],
+        },
+    }
+
+
+@pytest.fixture()
+def ad_client() -> ADClient:
+    client = ADClient()
+    client._conn = MagicMock()  # noqa: SLF001
+    client._conn.bound = True  # noqa: SLF001
+    client._batch_size = 2  # noqa: SLF001
+    return client
+
+
+def test_get_users_batches(ad_client: ADClient) -> None:
+    """
+    Логины ищутся пачками, ненайденные пользователи возвращаются как None
+    """
+
+    def _search(_: str, search_filter: str, **__: Any) -> tuple:
+        entries = [
+            make_entry(login) for login in ("User1", "user3") if login.lower() in search_filter
+        ]
+        return bool(entries), SEARCH_OK, entries, None
+
+    ad_client._conn.search.side_effect = _search  # noqa: SLF001
+
+    users = ad_client.get_users(["user1", "user2", "user3"])
+
+    assert ad_client._conn.search.call_count == 2  # noqa: SLF001, PLR2004
+    assert users["user1"] is not None
+    assert users["user1"].login == "user1"
+    assert users["user2"] is None
+    assert users["user3"] is not None
+
+
+def test_get_users_bad_login_isolated(ad_client: ADClient) -> None:
+    """
+    Ошибка поиска в пачке затрагивает только некорректный логин
+    """
+
+    def _search(_: str, search_filter: str, **__: Any) -> tuple:
+        if "bad" in search_filter:
+            return (
+                False,
+                {"result": 53, "description": "unwillingToPerform", "message": ""},
+                [],
+                None,
+            )
+        return True, SEARCH_OK, [make_entry("good")], None
+
+    ad_client._conn.search.side_effect = _search  # noqa: SLF001
+
+    users = ad_client.get_users(["good", "bad"])
+
+    assert users["good"] is not None
+    assert "bad" not in users
+
+
+def test_get_all_users_pages(ad_client: ADClient) -> None:
+    """
+    Постраничная выгрузка продолжается, пока сервер возвращает cookie
+    """
+    pages = iter(
+        [
+            (b"cookie", [make_entry("User1")]),
+            (b"", [make_entry("user2")]),
+        ]
+    )
+
+    def _search(*_: Any, **__: Any) -> tuple:
+        cookie, entries = next(pages)
+        controls = {"1.2.840.113556.1.4.319": {"value": {"cookie": cookie}}}
+        return True, {**SEARCH_OK, "controls": controls}, entries, None
+
+    ad_client._conn.search.side_effect = _search  # noqa: SLF001
+
+    users = ad_client.get_all_users()
+
+    assert set(users) == {"user1", "user2"}
+    assert users["user1"].login == "User1"
+
+
+def test_decode_users_page() -> None:
+    """
+    Флаги и срок действия пароля разбираются из сырых атрибутов,
+    записи с неожиданными атрибутами пропускаются
+    """
+    broken = make_entry("broken")
+    broken["raw_attributes"]["userAccountControl"] = [b"garbage"]
+    response = [
+        make_entry("User1", uac=0x202, expiry=133_514_280_000_000_005),
+        make_entry("user2", uac_live=0x00800000, expiry=0x7FFFFFFFFFFFFFFF),
+        broken,
+        {"type": "searchResRef", "uri": ["ldap://other"]},
+    ]
+
+    users = decode_users_page(response)
+
+    assert set(users) == {"user1", "user2"}
+    assert users["user1"].login == "User1"
+    assert users["user1"].disabled
+    assert users["user1"].pwd_expiry == datetime(2024, 2, 3, 10, tzinfo=UTC)
+    assert not users["user1"].pwd_expired
+    assert users["user2"].pwd_expiry is None
+    assert users["user2"].pwd_expired
+
+
+def test_filetime_to_datetime() -> None:
+    """
+    Целочисленный перевод FILETIME совпадает с прежним переводом через секунды
+    """
+    filetime = 133_514_208_123_456_780
+
+    expected = datetime(1601, 1, 1, tzinfo=UTC) + timedelta(seconds=filetime / 10_000_000)
+
+    assert filetime_to_datetime(filetime) == expected
+    assert filetime_to_datetime(filetime).microsecond == 345678  # noqa: PLR2004
+
+
+def test_use_raw_entries() -> None:
+    """
+    Стратегия подменяется только у подключений SAFE_SYNC
+    """
+    conn = Connection(Server("ad", get_info=NONE), client_strategy=SAFE_SYNC)
+    use_raw_entries(conn)
+    assert isinstance(conn.strategy, RawEntriesStrategy)
+
+    with pytest.raises(TypeError):
+        use_raw_entries(Connection(Server("ad", get_info=NONE), client_strategy=SYNC))
+
+
+@pytest.mark.parametrize(
+    ("source", "watermark", "expected"),
+    [
+        ("dc1", "100", 100),
+        ("dc2", "100", None),
+        ("dc1", "500", None),
+        ("dc1", "garbage", None),
+    ],
+)
+def test_usn_mark_validation(source: str, watermark: str, expected: int | None) -> None:
+    """
+    Отметка uSNChanged отбрасывается при смене контроллера или некорректном значении
+    """
+    usn_mark = DBSyncState(
+        name="ad_usn_changed", source=source, watermark=watermark, updated_at=datetime.now(UTC)
+    )
+    server = ADServerState(server_id="dc1", highest_usn=200)
+
+    assert ADSyncer()._get_valid_usn(usn_mark, server) == expected  # noqa: SLF001
+
+
+@pytest.mark.parametrize(("server_id", "since_usn"), [("dc1", 100), ("dc2", 150), ("dc3", None)])
+def test_read_changes_uses_mark_of_connected_server(server_id: str, since_usn: int | None) -> None:
+    """
+    Изменения читаются от отметки того контроллера, к которому выполнено подключение.
+    Без отметки для этого контроллера выполняется полное обновление
+    """
+    usn_marks = {
+        source: DBSyncState(
+            name=f"ad_usn_changed:{source}",
+            source=source,
+            watermark=watermark,
+            updated_at=datetime.now(UTC),
+        )
+        for source, watermark in [("dc1", "100"), ("dc2", "150")]
+    }
+    ad = MagicMock()
+    ad.get_server_state.return_value = ADServerState(server_id=server_id, highest_usn=200)
+
+    _, _, is_full = ADSyncer()._read_changes(ad, usn_marks)  # noqa: SLF001
+
+    assert is_full == (since_usn is None)
+    if since_usn is None:
+        ad.get_all_users.assert_called_once()
+    else:
+        ad.get_changed_users.assert_called_once_with(since_usn)
+
+
+def test_ad_secrets_require_urls() -> None:
+    """
+    Без адресов контроллеров домена конфигурация не загружается
+    """
+    with pytest.raises(ValidationError, match="at least one AD server url"):
+        ADSecrets(urls=[], user="user", password="password")  # type: ignore
+
+
+async def test_pool_rebinds_failed_connection(mocker: MockerFixture) -> None:
+    """
+    При обрыве подключения пул переподключается и повторяет запрос
+    """
+    mocker.patch.object(ADClient, "bind")
+    mocker.patch.object(ADClient, "unbind")
+    calls: list[ADClient] = []
+
+    def _request(ad: ADClient) -> str:
+        calls.append(ad)
+        if len(calls) == 1:
+            raise ADConnectionError("connection lost")
+        return "ok"
+
+    async with ADClientPool(size=1) as pool:
+        assert await pool.run(_request) == "ok"
+
+    assert len(calls) == 2  # noqa: PLR2004
+    assert ADClient.bind.call_count == 2  # type: ignore  # noqa: PLR2004
+
+
+def test_router_prefers_fast_healthy_servers() -> None:
+    """
+    Подключения распределяются по самым быстрым серверам, недоступные уходят в конец
+    """
+    router = ADServerRouter(["ldap://slow", "ldap://fast", "ldap://down"])
+    router.record_latency("ldap://slow", "search", 0.5)
+    router.record_latency("ldap://fast", "search", 0.01)
+    router.record_latency("ldap://down", "search", 0.001)
+    router.mark_failed("ldap://down")
+
+    assert router.get_candidates(0) == ["ldap://fast", "ldap://slow", "ldap://down"]
+    assert router.get_candidates(1)[0] == "ldap://slow"
+
+
+async def test_refresh_in_batches_stops_on_error(mocker: MockerFixture) -> None:
+    """
+    Ошибка в одной пачке отменяет остальные запросы, и обновление завершается с этой ошибкой
+    """
+    syncer = ADSyncer()
+    syncer._batch_size = 1  # noqa: SLF001
+    cancelled = asyncio.Event()
+
+    async def _get_users(logins: Iterable[str]) -> dict[str, ADUser | None]:
+        if list(logins) == ["bad"]:
+            raise ADError("search failed")
+        try:
+            await asyncio.Event().wait()
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+        return {}
+
+    mocker.patch.object(syncer, "_get_users", side_effect=_get_users)
+    save_refreshed = mocker.patch.object(syncer, "_save_refreshed")
+    users = [UserToRefresh(1, "slow"), UserToRefresh(2, "bad")]
+
+    with pytest.raises(ExceptionGroup) as exc_info:
+        await syncer._refresh_in_batches(RunContext(), users, None)  # noqa: SLF001
+
+    assert exc_info.group_contains(ADError)
+    assert cancelled.is_set()
+    save_refreshed.assert_not_called()
+
+
+async def test_sync_changes_writes_in_chunks(mocker: MockerFixture) -> None:
+    """
+    Изменения записываются пачками по write_chunk_size, каждая в своей транзакции.
+    Кандидаты на уведомление передаются после каждой пачки, а отметка uSNChanged
+    сохраняется только после всех пачек
+    """
+    run = RunContext()
+    syncer = ADSyncer()
+    syncer._write_chunk_size = 2  # noqa: SLF001
+    users = [UserToRefresh(user_id, f"user{user_id}") for user_id in range(1, 6)]
+    # Пароли нечетных пользователей истекают через 7 дней - это порог уведомления
+    changed = {
+        user.ad_login: ADUser(
+            login=user.ad_login,
+            disabled=False,
+            pwd_expiry=run.start_of_day(7 if user.id % 2 else 100) + timedelta(hours=12),
+            pwd_expired=False,
+        )
+        for user in users
+    }
+    server = ADServerState(server_id="dc1", highest_usn=200)
+    mocker.patch.object(syncer._pool, "run", return_value=(server, changed, False))  # noqa: SLF001
+
+    events: list[tuple[str, Any]] = []
+
+    async def _execute(_: object, params: dict[str, Any] | None = None) -> list[tuple[int, str]]:
+        if params is None:
+            return [(user.id, user.ad_login) for user in users]
+        events.append(("update", params["ids"]))
+        return []
+
+    async def _merge(state: DBSyncState) -> None:
+        events.append(("usn_mark", state.name))
+
+    async def _publish_candidates(candidates: list[int], _: object) -> None:
+        events.append(("candidates", candidates))
+
+    session = mocker.AsyncMock()
+    session.execute.side_effect = _execute
+    session.merge.side_effect = _merge
+    sessionmaker = mocker.patch("src.active_directory.db_sessionmaker")
+    sessionmaker.return_value.__aenter__.return_value = session
+    sessionmaker.begin.return_value.__aenter__.return_value = session
+    mocker.patch.object(syncer, "_publish_candidates", side_effect=_publish_candidates)
+
+    await syncer._sync_changes(run, {}, asyncio.Queue())  # noqa: SLF001
+
+    assert events == [
+        ("update", [1, 2]),
+        ("candidates", [1]),
+        ("update", [3, 4]),
+        ("candidates", [3]),
+        ("update", [5]),
+        ("candidates", [5]),
+        ("usn_mark", "ad_usn_changed:dc1"),
+    ]
+    # Три пачки и отметка - четыре транзакции
+    assert sessionmaker.begin.call_count == 4  # noqa: PLR2004
+
+
+def test_next_refresh_at_next_threshold() -> None:
+    """
+    Следующее обновление назначается на день ближайшего порога уведомления
+    """
+    now = datetime.now(MSK)
+
+    next_refresh_at = ADSyncer()._get_next_refresh_at(RunContext(now), 10)  # noqa: SLF001
+
+    # До истечения 10 дней, ближайший порог - 7 дней
+    assert next_refresh_at == datetime.combine(now.date() + timedelta(days=3), time(), tzinfo=MSK)
+
+
+def test_next_refresh_at_without_expiry() -> None:
+    """
+    Пользователи без срока действия пароля обновляются раз в max_refresh_interval_days
+    """
+    next_refresh_at = ADSyncer()._get_next_refresh_at(RunContext(), None)  # noqa: SLF001
+
+    expected = datetime.now(MSK) + timedelta(days=settings.ad_sync.max_refresh_interval_days)
+    assert abs(next_refresh_at - expected) < timedelta(minutes=1)
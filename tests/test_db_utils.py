@@ -0,0 +1,64 @@
+from sqlalchemy import inspect, text
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from src.database.db_utils import prepare_databse
+from src.database.models import LONG_AGO
+
+# Таблица user в том виде, в каком ее создавала первая версия сервиса
+_BASELINE_USER_TABLE = """
+CREATE TABLE "user" (
+    id SERIAL PRIMARY KEY,
+    externaldb_id VARCHAR NOT NULL UNIQUE,
+    externaldb_fio VARCHAR NOT NULL,
+    externaldb_group VARCHAR NOT NULL,
+    externaldb_email VARCHAR NOT NULL,
+    ad_login VARCHAR NOT NULL,
+    ad_disabled BOOLEAN NOT NULL,
+    ad_pwd_expiry TIMESTAMP WITH TIME ZONE,
+    ad_pwd_expired BOOLEAN NOT NULL,
+    last_ad_refresh TIMESTAMP WITH TIME ZONE NOT NULL,
+    last_notification TIMESTAMP WITH TIME ZONE NOT NULL
+)
+"""
+
+
+async def test_prepare_database_upgrades_baseline_schema(db_engine: AsyncEngine) -> None:
+    """
+    Новые колонки добавляются в существующую таблицу, старые строки получают значения по умолчанию
+    """
+    async with db_engine.begin() as conn:
+        await conn.execute(text(_BASELINE_USER_TABLE))
+        await conn.execute(
+            text(
+                """
+                INSERT INTO "user" (
+                    externaldb_id, externaldb_fio, externaldb_group, externaldb_email, ad_login,
+                    ad_disabled, ad_pwd_expiry, ad_pwd_expired,
+                    last_ad_refresh, last_notification
+                )
+                VALUES (
+                    '1', 'fio', 'group', 'user@example.com', 'user',
+                    false, '2024-02-03 12:00+03', false, now(), now()
+                )
+                """
+            )
+        )
+
+    await prepare_databse()
+    # Повторный запуск на уже обновленной схеме ничего не меняет
+    await prepare_databse()
+
+    async with db_engine.connect() as conn:
+        columns = await conn.run_sync(
+            lambda sync_conn: {column["name"] for column in inspect(sync_conn).get_columns("user")}
+        )
+        row = (
+            await conn.execute(
+                text('SELECT next_refresh_at, ad_pwd_expiry_date, externaldb_checksum FROM "user"')
+            )
+        ).one()
+
+    assert {"next_refresh_at", "ad_pwd_expiry_date", "externaldb_checksum"} <= columns
+    assert row.next_refresh_at == LONG_AGO
+    assert str(row.ad_pwd_expiry_date) == "2024-02-03"
+    assert row.externaldb_checksum is None
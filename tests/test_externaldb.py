@@ -0,0 +1,225 @@
+from collections.abc import Generator
+from datetime import datetime
+
+import pytest
+from pytest_mock import MockerFixture
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from src.database import db_sessionmaker
+from src.database.db_utils import prepare_databse
+from src.database.models import LONG_AGO, DBSyncState, DBUser
+from src.externaldb import (
+    ExternalDBClient,
+    ExternalDBGroup,
+    ExternalDBSyncer,
+    ExternalDBUser,
+    SyncStats,
+    build_group_closure,
+)
+from src.utils import MSK
+
+
+def make_externaldb_user(
+    user_id: str, ad_login: str = "", checksum: bytes = b"0"
+) -> ExternalDBUser:
+    return ExternalDBUser(
+        id=user_id,
+        fio="fio",
+        group="group",
+        email=f"{user_id}@example.com",
+        ad_login=ad_login or f"user{user_id}",
+        checksum=checksum,
+    )
+
+
+def make_db_user(externaldb_user: ExternalDBUser) -> DBUser:
+    return DBUser(
+        externaldb_id=externaldb_user.id,
+        externaldb_fio=externaldb_user.fio,
+        externaldb_group=externaldb_user.group,
+        externaldb_email=externaldb_user.email,
+        ad_login=externaldb_user.ad_login,
+        externaldb_checksum=externaldb_user.checksum,
+        next_refresh_at=datetime.now(MSK),
+    )
+
+
+async def save_sync_states(users_watermark: str, full_sync_at: datetime) -> None:
+    async with db_sessionmaker.begin() as session:
+        session.add_all(
+            [
+                DBSyncState(
+                    name="externaldb_users",
+                    source="dbo.Users",
+                    watermark=users_watermark,
+                    updated_at=datetime.now(MSK),
+                ),
+                DBSyncState(
+                    name="externaldb_full_sync",
+                    source="dbo.Users",
+                    watermark=users_watermark,
+                    updated_at=full_sync_at,
+                ),
+            ]
+        )
+
+
+@pytest.fixture()
+def syncer(mocker: MockerFixture) -> ExternalDBSyncer:
+    syncer = ExternalDBSyncer()
+    syncer._externaldb = mocker.create_autospec(ExternalDBClient, instance=True)  # noqa: SLF001
+    syncer._externaldb.get_users_checksum.return_value = "checksum"  # noqa: SLF001
+    syncer._chunk_size = 2  # noqa: SLF001
+    mocker.patch.object(syncer, "_get_group_ids", return_value=["group"])
+    return syncer
+
+
+def test_build_group_closure() -> None:
+    """
+    Таблица замыкания содержит все пары предок-потомок, включая саму группу
+    """
+    groups = [
+        ExternalDBGroup(id="1", full_name="root", parent_id=None),
+        ExternalDBGroup(id="2", full_name="child", parent_id="1"),
+        ExternalDBGroup(id="3", full_name="grandchild", parent_id="2"),
+    ]
+
+    closure = build_group_closure(groups)
+
+    assert sorted(closure) == [
+        ("1", "1", 0),
+        ("1", "2", 1),
+        ("1", "3", 2),
+        ("2", "2", 0),
+        ("2", "3", 1),
+        ("3", "3", 0),
+    ]
+
+
+def test_build_group_closure_cycle() -> None:
+    """
+    Цикл в дереве групп не приводит к зацикливанию
+    """
+    groups = [
+        ExternalDBGroup(id="1", full_name="a", parent_id="2"),
+        ExternalDBGroup(id="2", full_name="b", parent_id="1"),
+    ]
+
+    closure = build_group_closure(groups)
+
+    assert sorted(closure) == [("1", "1", 0), ("1", "2", 1), ("2", "1", 1), ("2", "2", 0)]
+
+
+async def test_full_sync_upserts_and_deletes(
+    db_engine: AsyncEngine, syncer: ExternalDBSyncer, mocker: MockerFixture
+) -> None:
+    """
+    Полная синхронизация вставляет новых, обновляет изменившихся и удаляет
+    отсутствующих во внешней БД пользователей. Неизменившиеся строки не переписываются.
+    Пока читается внешняя БД, подключение к Postgres не занято
+    """
+    await prepare_databse()
+    unchanged = make_externaldb_user("1")
+    renamed = make_externaldb_user("2", ad_login="new_login", checksum=b"1")
+    async with db_sessionmaker.begin() as session:
+        session.add_all(
+            [
+                make_db_user(unchanged),
+                make_db_user(make_externaldb_user("2", ad_login="old_login")),
+                make_db_user(make_externaldb_user("3")),
+            ]
+        )
+    externaldb_users = [unchanged, renamed, make_externaldb_user("4")]
+
+    checked_out: list[int] = []
+
+    def _iter_users(*_: object) -> Generator[list[ExternalDBUser], None, None]:
+        # Пачками по chunk_size, каждая копируется своей транзакцией
+        for i in range(0, len(externaldb_users), 2):
+            checked_out.append(db_engine.pool.checkedout())  # type: ignore[attr-defined]
+            yield externaldb_users[i : i + 2]
+
+    syncer._externaldb.iter_users.side_effect = _iter_users  # noqa: SLF001
+    syncer._incremental = False  # noqa: SLF001
+    report = mocker.patch.object(syncer, "_report")
+
+    await syncer.sync()
+
+    report.assert_called_once_with(SyncStats(inserted=1, updated=1, deleted=1, unchanged=1))
+    assert checked_out == [0, 0]
+    async with db_sessionmaker() as session:
+        users = {user.externaldb_id: user for user in await session.scalars(select(DBUser))}
+    assert sorted(users) == ["1", "2", "4"]
+    assert users["2"].ad_login == "new_login"
+    # Для сменившегося логина данные из AD перечитываются
+    assert users["2"].next_refresh_at == LONG_AGO
+    assert users["1"].next_refresh_at != LONG_AGO
+
+
+@pytest.mark.usefixtures("db_engine")
+async def test_incremental_sync_skips_unchanged_users(
+    syncer: ExternalDBSyncer, mocker: MockerFixture
+) -> None:
+    """
+    Если общая контрольная сумма пользователей не изменилась, внешняя БД не читается
+    """
+    await prepare_databse()
+    await save_sync_states("checksum", full_sync_at=datetime.now(MSK))
+    report = mocker.patch.object(syncer, "_report")
+
+    await syncer.sync()
+
+    syncer._externaldb.iter_user_checksums.assert_not_called()  # noqa: SLF001
+    syncer._externaldb.iter_users.assert_not_called()  # noqa: SLF001
+    report.assert_not_called()
+
+
+@pytest.mark.usefixtures("db_engine")
+async def test_incremental_sync_refetches_changed_users(
+    syncer: ExternalDBSyncer, mocker: MockerFixture
+) -> None:
+    """
+    Инкрементальная синхронизация полностью перечитывает только новых и изменившихся
+    пользователей и удаляет тех, кого нет в списке сумм
+    """
+    await prepare_databse()
+    await save_sync_states("old_checksum", full_sync_at=datetime.now(MSK))
+    unchanged = make_externaldb_user("1")
+    renamed = make_externaldb_user("2", ad_login="new_login", checksum=b"1")
+    added = make_externaldb_user("4")
+    async with db_sessionmaker.begin() as session:
+        session.add_all(
+            [
+                make_db_user(unchanged),
+                make_db_user(make_externaldb_user("2", ad_login="old_login")),
+                make_db_user(make_externaldb_user("3")),
+            ]
+        )
+    externaldb_users = {user.id: user for user in [unchanged, renamed, added]}
+
+    def _iter_user_checksums(*_: object) -> Generator[list[tuple[str, bytes]], None, None]:
+        yield [(user.id, user.checksum) for user in externaldb_users.values()]
+
+    def _iter_users(
+        _: list[str], __: int, user_ids: list[str]
+    ) -> Generator[list[ExternalDBUser], None, None]:
+        yield [externaldb_users[user_id] for user_id in user_ids]
+
+    syncer._externaldb.iter_user_checksums.side_effect = _iter_user_checksums  # noqa: SLF001
+    syncer._externaldb.iter_users.side_effect = _iter_users  # noqa: SLF001
+    report = mocker.patch.object(syncer, "_report")
+
+    await syncer.sync()
+
+    refetched = [call.args[2] for call in syncer._externaldb.iter_users.call_args_list]  # noqa: SLF001
+    assert sorted(user_id for user_ids in refetched for user_id in user_ids) == ["2", "4"]
+    report.assert_called_once_with(SyncStats(inserted=1, updated=1, deleted=1, unchanged=1))
+    async with db_sessionmaker() as session:
+        users = {user.externaldb_id: user for user in await session.scalars(select(DBUser))}
+        users_state = await session.get(DBSyncState, "externaldb_users")
+    assert sorted(users) == ["1", "2", "4"]
+    assert users["2"].ad_login == "new_login"
+    assert users["2"].externaldb_checksum == b"1"
+    assert users_state is not None
+    assert users_state.watermark == "checksum"
@@ -0,0 +1,294 @@
+import asyncio
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock
+
+import aiosmtplib
+import pytest
+from pytest_mock import MockerFixture
+
+from src import metrics
+from src.config import ChannelLimitSettings, settings
+from src.database.models import DBUser
+from src.database.rows import OutboxRow, UserToNotify
+from src.notification.mailsender import Email, MailSenderError
+from src.notification.notificator import (
+    MailNotificator,
+    Notificator,
+    PortalNotificator,
+    SendResult,
+)
+from src.notification.outbox import NotificationOutbox, OutboxBatch, OutboxResults
+from src.notification.portalsender import PortalNotification, PortalSender
+from src.notification.rendering import NotificationRenderer
+from src.notification.resilience import AdaptiveLimiter
+from src.run_context import RunContext
+from src.utils import MSK
+
+
+def make_user(login: str) -> DBUser:
+    return DBUser(
+        externaldb_id=login,
+        externaldb_fio="fio",
+        externaldb_group="group",
+        externaldb_email=f"{login}@example.com",
+        ad_login=login,
+    )
+
+
+def make_user_to_notify(user_id: int, login: str) -> UserToNotify:
+    return UserToNotify(
+        id=user_id,
+        externaldb_id=login,
+        externaldb_fio="fio",
+        externaldb_group="group",
+        externaldb_email=f"{login}@example.com",
+        ad_login=login,
+        ad_disabled=False,
+        ad_pwd_expiry=None,
+        ad_pwd_expired=False,
+    )
+
+
+async def test_outbox_worker_records_results(
+    mocker: MockerFixture, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    Результаты отправки записываются в очередь по мере завершения. Строки пользователей,
+    которых нет в БД, отмечаются как неудачные
+    """
+    monkeypatch.setattr(settings.notification, "retry_attempts", 1)
+
+    async def _send(_: object, email: Email) -> None:
+        if email.recipient.startswith("slow"):
+            await asyncio.sleep(0.05)
+            raise MailSenderError(email, aiosmtplib.SMTPResponseException(550, "rejected"))
+        if email.recipient.startswith("busy"):
+            raise MailSenderError(email, aiosmtplib.SMTPResponseException(421, "busy"))
+
+    monkeypatch.setattr("src.notification.mailsender.MailSender.send", _send)
+    notificator = Notificator()
+    outbox = mocker.create_autospec(NotificationOutbox, instance=True)
+    notificator._outbox = outbox  # noqa: SLF001
+    users = [make_user_to_notify(1, "good"), make_user_to_notify(2, "busy")]
+    users.append(make_user_to_notify(3, "slow"))
+    rows = [OutboxRow(10, 1), OutboxRow(11, 1), OutboxRow(12, 2), OutboxRow(13, 3)]
+    rows.append(OutboxRow(14, 4))
+    outbox.claim.side_effect = [
+        OutboxBatch(rows, {user.id: user for user in users}),
+        OutboxBatch([]),
+    ]
+    saved: list[OutboxResults] = []
+    outbox.save_results.side_effect = saved.append
+    mail_notificator = next(n for n in notificator._notificators if n.name == "email")  # noqa: SLF001
+
+    await notificator._outbox_worker(mail_notificator, RunContext())  # noqa: SLF001
+
+    assert len(saved) > 1
+    assert 13 not in saved[0].failed  # noqa: PLR2004
+    assert sorted(row_id for results in saved for row_id in results.sent) == [10, 11]
+    assert [row_id for results in saved for row_id in results.deferred] == [12]
+    assert sorted(row_id for results in saved for row_id in results.failed) == [13, 14]
+
+
+async def test_channel_concurrency_limit(monkeypatch: pytest.MonkeyPatch) -> None:
+    """
+    Одновременных отправок по каналу не больше, чем задано в настройках
+    """
+    limits = ChannelLimitSettings(
+        initial_concurrency=2, max_concurrency=2, target_latency_seconds=1
+    )
+    monkeypatch.setitem(settings.notification.channel_limits, "email", limits)
+    in_flight = 0
+    max_in_flight = 0
+
+    async def _send(_: object, __: Email) -> None:
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+
+    monkeypatch.setattr("src.notification.mailsender.MailSender.send", _send)
+    notifications = NotificationRenderer().render_all(
+        [make_user(f"user{i}") for i in range(10)], RunContext()
+    )
+
+    results = await MailNotificator(asyncio.Semaphore(10)).send_many(notifications)
+
+    assert max_in_flight == 2  # noqa: PLR2004
+    assert results == [SendResult.SENT] * 10
+
+
+async def test_portal_rejected_batch_attributed_per_user(
+    monkeypatch: pytest.MonkeyPatch, mock_portal_send: MagicMock
+) -> None:
+    """
+    Если сервис отклонил пачку, она переотправляется по одному и ошибка
+    приписывается только проблемному пользователю
+    """
+    monkeypatch.setattr(settings, "portal_title", "title")
+    monkeypatch.setattr(settings, "portal_summary", "summary")
+    monkeypatch.setattr(settings, "portal_content", "content")
+    response = mock_portal_send.return_value.__aenter__.return_value
+
+    def _post(*_: object, json: dict, **__: object) -> MagicMock:
+        response.json.return_value = {"success": "bad" not in json["users"]}
+        return mock_portal_send.return_value
+
+    mock_portal_send.side_effect = _post
+    users = [make_user("good"), make_user("bad")]
+
+    notifications = NotificationRenderer().render_all(users, RunContext())
+
+    results = await PortalNotificator(asyncio.Semaphore(10)).send_many(notifications)
+
+    assert results == [SendResult.SENT, SendResult.FAILED]
+    assert mock_portal_send.call_count == 3  # noqa: PLR2004
+
+
+def test_renderer_dedupes_and_caches_templates(monkeypatch: pytest.MonkeyPatch) -> None:
+    """
+    Одинаковые шаблоны компилируются один раз, шаблоны только от числа дней кэшируются
+    """
+    monkeypatch.setattr(settings, "portal_title", "{{ user.ad_login }}")
+    monkeypatch.setattr(settings, "email_subject", "{{ user.ad_login }}")
+    monkeypatch.setattr(settings, "portal_summary", "{{ user.ad_pwd_expires_in_days }} days")
+    renderer = NotificationRenderer()
+    summary_template = renderer._templates["portal_summary"]  # noqa: SLF001
+
+    first = renderer.render(make_user("first"), RunContext())
+    second = renderer.render(make_user("second"), RunContext())
+
+    assert renderer._templates["portal_title"] is renderer._templates["email_subject"]  # noqa: SLF001
+    assert summary_template.days_only
+    assert not renderer._templates["portal_title"].days_only  # noqa: SLF001
+    assert first.portal_title == "first"
+    assert second.portal_summary == "None days"
+    assert summary_template._render_for_days.cache_info().hits == 1  # noqa: SLF001
+
+
+def test_shipped_portal_templates_are_batched() -> None:
+    """
+    Шаблоны порталов из конфигурации не зависят от пользователя: уведомления
+    с одним сроком истечения уходят одним запросом, тексты берутся из кэша
+    """
+    expiry = datetime.now(MSK) + timedelta(days=7)
+    users = [make_user(f"user{i}") for i in range(3)]
+    for user in users:
+        user.ad_pwd_expiry = expiry
+    renderer = NotificationRenderer()
+
+    notifications = renderer.render_all(users, RunContext())
+
+    batches = PortalSender().make_batches(
+        [
+            PortalNotification(
+                user_id=notif.user.externaldb_id,
+                title=notif.portal_title,
+                summary=notif.portal_summary,
+                content=notif.portal_content,
+            )
+            for notif in notifications
+        ]
+    )
+    assert [len(batch) for batch in batches] == [3]
+    assert "user0" not in notifications[0].portal_content
+    assert renderer._templates["portal_content"]._render_for_days.cache_info().hits == 2  # noqa: SLF001, PLR2004
+
+
+async def test_mail_retries_transient_error(
+    sent_emails: list[Email], monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    Временная ошибка SMTP (4xx) повторяется, уведомление доставляется
+    """
+    calls: list[Email] = []
+
+    async def _send(_: object, email: Email) -> None:
+        calls.append(email)
+        if len(calls) == 1:
+            raise MailSenderError(email, aiosmtplib.SMTPResponseException(421, "busy"))
+        sent_emails.append(email)
+
+    monkeypatch.setattr("src.notification.mailsender.MailSender.send", _send)
+    notification = NotificationRenderer().render(make_user("user"), RunContext())
+
+    result = await MailNotificator(asyncio.Semaphore(10)).send(notification)
+
+    assert result == SendResult.SENT
+    assert len(calls) == 2  # noqa: PLR2004
+    assert len(sent_emails) == 1
+
+
+async def test_circuit_breaker_fails_fast(
+    monkeypatch: pytest.MonkeyPatch, mock_portal_send: MagicMock
+) -> None:
+    """
+    После breaker_failure_threshold временных ошибок подряд канал отключается,
+    оставшиеся уведомления откладываются без запросов к сервису
+    """
+    monkeypatch.setattr(settings.notification, "retry_attempts", 1)
+    monkeypatch.setattr(settings.notification, "breaker_failure_threshold", 2)
+    limits = ChannelLimitSettings(
+        initial_concurrency=1, max_concurrency=1, target_latency_seconds=1
+    )
+    monkeypatch.setitem(settings.notification.channel_limits, "portals", limits)
+    # Отдельный запрос на каждого пользователя
+    monkeypatch.setattr(settings, "portal_summary", "{{ user.ad_login }}")
+    mock_portal_send.side_effect = Exception()
+    notifications = NotificationRenderer().render_all(
+        [make_user(f"user{i}") for i in range(5)], RunContext()
+    )
+
+    results = await PortalNotificator(asyncio.Semaphore(10)).send_many(notifications)
+
+    assert results == [SendResult.DEFERRED] * 5
+    assert mock_portal_send.call_count == 2  # noqa: PLR2004
+    assert metrics.notification_circuit_open.labels("portals")._value.get() == 1  # noqa: SLF001
+
+
+async def test_adaptive_limiter_aimd() -> None:
+    """
+    Лимит растет на 1 за окно быстрых ответов и уменьшается вдвое при перегрузке
+    """
+    limits = ChannelLimitSettings(
+        initial_concurrency=2, max_concurrency=3, target_latency_seconds=1
+    )
+    limiter = AdaptiveLimiter("email", limits)
+
+    # 2 -> 2.5 -> 2.9 -> 3.2
+    for _ in range(3):
+        async with limiter.acquire(lambda _: True):
+            pass
+    assert limiter.limit == 3  # noqa: PLR2004
+
+    for _ in range(10):
+        async with limiter.acquire(lambda _: True):
+            pass
+    assert limiter.limit == 3  # noqa: PLR2004
+
+    with pytest.raises(ConnectionError):
+        async with limiter.acquire(lambda e: isinstance(e, ConnectionError)):
+            raise ConnectionError
+    assert limiter.limit == 1
+
+
+async def test_resend_deferred_purges_stale_rows(mocker: MockerFixture) -> None:
+    """
+    Перед повторной отправкой удаляются уведомления прошлых дней
+    """
+    notificator = Notificator()
+    outbox = mocker.create_autospec(NotificationOutbox, instance=True)
+    notificator._outbox = outbox  # noqa: SLF001
+    calls: list[tuple[str, object]] = []
+    outbox.purge_stale.side_effect = lambda today: calls.append(("purge", today))
+    mocker.patch.object(
+        notificator,
+        "_drain_outbox",
+        side_effect=lambda run: calls.append(("drain", run.today)),
+    )
+
+    await notificator.resend_deferred()
+
+    assert [name for name, _ in calls] == ["purge", "drain"]
+    assert calls[0][1] == calls[1][1]
@@ -0,0 +1,80 @@
+import asyncio
+
+import pytest
+from pytest_mock import MockerFixture
+
+from src.active_directory import ADError, ADSyncer
+from src.config import settings
+from src.externaldb import ExternalDBSyncer
+from src.notification.notificator import Notificator
+from src.pipeline import run_pipelined
+from src.run_context import RunContext
+
+
+async def test_run_pipelined_backpressure(
+    mocker: MockerFixture, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    Пачки из AD передаются в рассылку по порядку, при заполненной очереди обновление
+    из AD ждет рассылку, None в конце очереди завершает рассылку
+    """
+    monkeypatch.setattr(settings.pipeline, "queue_size", 1)
+    events: list[str] = []
+    received: list[list[int]] = []
+
+    async def _sync(_: RunContext, candidates: "asyncio.Queue[list[int] | None]") -> None:
+        for user_id in range(3):
+            await candidates.put([user_id])
+            events.append(f"put {user_id}")
+
+    async def _send_all(_: RunContext, candidates: "asyncio.Queue[list[int] | None]") -> None:
+        while (user_ids := await candidates.get()) is not None:
+            events.append(f"got {user_ids[0]}")
+            received.append(user_ids)
+            await asyncio.sleep(0.01)
+
+    ad_syncer = mocker.create_autospec(ADSyncer, instance=True)
+    ad_syncer.sync.side_effect = _sync
+    notificator = mocker.create_autospec(Notificator, instance=True)
+    notificator.send_all.side_effect = _send_all
+
+    async with asyncio.timeout(1):
+        await run_pipelined(
+            mocker.create_autospec(ExternalDBSyncer, instance=True), ad_syncer, notificator
+        )
+
+    assert received == [[0], [1], [2]]
+    # В очереди не больше одной пачки: следующая кладется только после того, как забрана
+    # предыдущая
+    for user_id in range(1, 3):
+        assert events.index(f"got {user_id - 1}") < events.index(f"put {user_id}")
+    # Обе стадии считают сроки от одного момента запуска
+    assert ad_syncer.sync.call_args.args[0] is notificator.send_all.call_args.args[0]
+
+
+async def test_run_pipelined_ad_failure_cancels_notify(mocker: MockerFixture) -> None:
+    """
+    Ошибка обновления из AD отменяет рассылку, которая ждет следующую пачку
+    """
+    cancelled = asyncio.Event()
+
+    async def _send_all(_: RunContext, candidates: "asyncio.Queue[list[int] | None]") -> None:
+        try:
+            await candidates.get()
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    ad_syncer = mocker.create_autospec(ADSyncer, instance=True)
+    ad_syncer.sync.side_effect = ADError("search failed")
+    notificator = mocker.create_autospec(Notificator, instance=True)
+    notificator.send_all.side_effect = _send_all
+
+    with pytest.raises(ExceptionGroup) as exc_info:
+        async with asyncio.timeout(1):
+            await run_pipelined(
+                mocker.create_autospec(ExternalDBSyncer, instance=True), ad_syncer, notificator
+            )
+
+    assert exc_info.group_contains(ADError)
+    assert cancelled.is_set()
@@ -0,0 +1,45 @@
+from datetime import datetime, time, timedelta
+
+from src.database.models import DBUser, get_pwd_expiry_date
+from src.run_context import RunContext
+from src.utils import MSK
+
+
+def test_days_to_expiry_matches_expiry_date() -> None:
+    """
+    Дни до истечения совпадают с get_pwd_expiry_date, включая границу 09:00 по МСК
+    """
+    run = RunContext()
+    expiry_times = [time(0), time(8, 59), time(9), time(9, 0, 0, 1), time(12), time(23, 59)]
+    for days in range(-2, 5):
+        for expiry_time in expiry_times:
+            expiry = datetime.combine(run.today + timedelta(days=days), expiry_time, tzinfo=MSK)
+            expected = (get_pwd_expiry_date(expiry) - run.today).days
+
+            assert run.days_to_expiry(expiry, disabled=False, expired=False) == expected
+
+
+def test_days_to_expiry_fixed_at_run_start() -> None:
+    """
+    Запуск, перешедший через полночь, считает дни от своего начала
+    """
+    run = RunContext(datetime(2024, 3, 1, 23, 59, tzinfo=MSK))
+    user = DBUser(
+        externaldb_id="1",
+        externaldb_fio="fio",
+        externaldb_group="group",
+        externaldb_email="email",
+        ad_login="user",
+        ad_pwd_expiry=datetime(2024, 3, 8, 12, tzinfo=MSK),
+    )
+    disabled_user = DBUser(
+        externaldb_id="2",
+        externaldb_fio="fio",
+        externaldb_group="group",
+        externaldb_email="email",
+        ad_login="disabled",
+        ad_disabled=True,
+        ad_pwd_expiry=datetime(2024, 3, 8, 12, tzinfo=MSK),
+    )
+
+    assert run.days_to_expiry_many([user, disabled_user]) == [7, None]
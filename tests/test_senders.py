@@ -1,8 +1,12 @@
+import re
+from email import message_from_bytes, policy
 from unittest.mock import AsyncMock, MagicMock
 
+import aiosmtplib
 import pytest
 
-from src.notification.mailsender import Email, MailSender, MailSenderError
+from src.config import settings
+from src.notification.mailsender import Email, MailSender, MailSenderError, MessageFactory
 from src.notification.portalsender import PortalNotification, PortalNotificationError, PortalSender
 
 
@@ -31,7 +35,7 @@ async def test_sent_emails(mailsender: MailSender, sent_emails: list[Email]) ->
 
 async def test_mock_smtp_send(mailsender: MailSender, mock_smtp_send: AsyncMock) -> None:
     """
-    Проверка, что мок для aiosmtplib.SMTP.send_message работает корректно
+    Проверка, что мок для aiosmtplib.SMTP.sendmail работает корректно
     """
     await mailsender.send(email)
     mock_smtp_send.assert_awaited_once()
@@ -39,13 +43,124 @@ async def test_mock_smtp_send(mailsender: MailSender, mock_smtp_send: AsyncMock)
 
 async def test_email_send_error(mailsender: MailSender, mock_smtp_send: AsyncMock) -> None:
     """
-    Проверка, что мок для aiosmtplib.SMTP.send_message работает корректно
+    Проверка, что мок для aiosmtplib.SMTP.sendmail работает корректно
     """
     mock_smtp_send.side_effect = Exception()
     with pytest.raises(MailSenderError):
         await mailsender.send(email)
 
 
+async def test_smtp_connection_reused(
+    monkeypatch: pytest.MonkeyPatch, mock_smtp_send: AsyncMock
+) -> None:
+    """
+    Письма отправляются через одно подключение с RSET между ними,
+    после max_messages_per_connection подключение переоткрывается
+    """
+    monkeypatch.setattr(settings.smtp_pool, "size", 1)
+    monkeypatch.setattr(settings.smtp_pool, "max_messages_per_connection", 2)
+    mailsender = MailSender()
+    smtp = mailsender._connections[0].smtp  # noqa: SLF001
+
+    for _ in range(3):
+        await mailsender.send(email)
+
+    assert mock_smtp_send.await_count == 3  # noqa: PLR2004
+    assert smtp.connect.await_count == 2  # noqa: PLR2004
+    smtp.rset.assert_awaited_once()
+    smtp.quit.assert_awaited_once()
+
+
+async def test_smtp_reconnect_on_disconnect(
+    monkeypatch: pytest.MonkeyPatch, mock_smtp_send: AsyncMock
+) -> None:
+    """
+    Если сервер закрыл подключение, письмо отправляется повторно через новое
+    """
+    monkeypatch.setattr(settings.smtp_pool, "size", 1)
+    mailsender = MailSender()
+    smtp = mailsender._connections[0].smtp  # noqa: SLF001
+
+    async def _send(*_: object) -> None:
+        if mock_smtp_send.await_count == 1:
+            smtp.is_connected = False
+            raise aiosmtplib.SMTPServerDisconnected("disconnected")
+
+    mock_smtp_send.side_effect = _send
+    await mailsender.send(email)
+
+    assert mock_smtp_send.await_count == 2  # noqa: PLR2004
+    assert smtp.connect.await_count == 2  # noqa: PLR2004
+
+
+def test_message_factory() -> None:
+    """
+    Собранное письмо разбирается пакетом email в исходные заголовки и тексты
+    """
+    factory = MessageFactory("Отправитель", "sender@example.com")
+    email = Email(
+        recipient="recipient@example.com",
+        subject="Истечение пароля",
+        content_plain="Текст",
+        content_html="<p>Текст</p>",
+    )
+
+    message = message_from_bytes(factory.build(email), policy=policy.default)
+
+    assert message["From"] == "Отправитель <sender@example.com>"
+    assert message["To"] == email.recipient
+    assert message["Subject"] == email.subject
+    plain, html = message.iter_parts()
+    assert plain.get_content() == email.content_plain
+    assert html.get_content_type() == "text/html"
+    assert html.get_content() == email.content_html
+
+
+def test_message_factory_folds_ascii_subject() -> None:
+    """
+    Длинная ASCII-тема переносится так, что строки заголовков не длиннее 78 символов
+    """
+    factory = MessageFactory("Отправитель", "sender@example.com")
+    email = Email(
+        recipient="recipient@example.com",
+        subject="Password expiry reminder: " + ", ".join(["your password expires soon"] * 5),
+        content_plain="Text",
+        content_html="<p>Text</p>",
+    )
+
+    raw = factory.build(email)
+
+    subject = re.search(rb"^Subject:.*?\r\n(?! )", raw, re.MULTILINE | re.DOTALL)
+    assert subject is not None
+    subject_lines = subject.group().split(b"\r\n")[:-1]
+    assert len(subject_lines) > 1
+    assert max(len(line) for line in subject_lines) <= 78  # noqa: PLR2004
+    message = message_from_bytes(raw, policy=policy.default)
+    assert message["Subject"] == email.subject
+
+
+@pytest.mark.parametrize(
+    ("recipient", "subject"),
+    [
+        ("recipient@example.com\r\nBcc: other@example.com", "Subject"),
+        ("recipient@example.com", "Subject\r\nBcc: other@example.com"),
+        ("recipient@example.com", "Тема\nBcc: other@example.com"),
+    ],
+)
+async def test_mailsender_rejects_header_injection(recipient: str, subject: str) -> None:
+    """
+    Перевод строки в адресе или теме не дает дописать заголовки: письмо не отправляется,
+    ошибка не считается временной
+    """
+    email = Email(recipient=recipient, subject=subject, content_plain="", content_html="")
+
+    with pytest.raises(ValueError, match="line break"):
+        MessageFactory("Отправитель", "sender@example.com").build(email)
+    with pytest.raises(MailSenderError) as exc_info:
+        await MailSender().send(email)
+    assert not exc_info.value.retriable
+
+
 @pytest.fixture()
 def portalsender() -> PortalSender:
     return PortalSender()
@@ -86,3 +201,18 @@ async def test_portal_send_error(portalsender: PortalSender, mock_portal_send: M
     mock_portal_send.side_effect = Exception()
     with pytest.raises(PortalNotificationError):
         await portalsender.send(notification)
+
+
+def test_portal_batches_identical_notifications(monkeypatch: pytest.MonkeyPatch) -> None:
+    """
+    Одинаковые уведомления отправляются одним запросом, не больше portal_batch_size за раз
+    """
+    monkeypatch.setattr(settings.notification, "portal_batch_size", 2)
+    notifications = [
+        PortalNotification(user_id=str(i), title="title", summary="summary", content=content)
+        for i, content in enumerate(["a", "a", "a", "b"])
+    ]
+
+    batches = PortalSender().make_batches(notifications)
+
+    assert [[notif.user_id for notif in batch] for batch in batches] == [["0", "1"], ["2"], ["3"]]